@@ -1,5 +1,6 @@
 import argparse
-from wsgiref.simple_server import make_server
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer
 
 import yaml
 import logging
@@ -10,9 +11,16 @@ import time
 from prometheus_client.core import REGISTRY
 
 from aliyun_exporter.collector import AliyunCollector, CollectorConfig
+from aliyun_exporter.planner import Planner, format_plan
+from aliyun_exporter.remote_write import PushLoop, RemoteWriter
 from aliyun_exporter.web import create_app
 
 
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    # concurrent scrapes are served in parallel and coalesced by the collector
+    daemon_threads = True
+
+
 def shutdown():
     logging.info('Shutting down, see you next time!')
     sys.exit(1)
@@ -29,19 +37,40 @@ def main():
                        help='path to configuration file.')
     parser.add_argument('-p', '--port', default=9525,
                         help='exporter exposed port')
+    subparsers = parser.add_subparsers(dest='command')
+    plan_parser = subparsers.add_parser('plan', help='estimate the API calls, duration and series of the configuration')
+    plan_parser.add_argument('-i', '--interval', type=int, default=None,
+                             help='scrape interval in seconds. default: the push interval or 60')
+    plan_parser.add_argument('-l', '--latency', type=float, default=0.5,
+                             help='assumed latency of an API call in seconds')
+    plan_parser.add_argument('--inventory', action='store_true',
+                             help='list the instances of every resource to estimate the series')
+    plan_parser.add_argument('--quota', action='append', default=[], metavar='PRODUCT=CALLS',
+                             help='monthly quota of an API product, may be repeated')
     args = parser.parse_args()
 
     with open(args.config_file, 'r') as config_file:
         cfg = yaml.load(config_file, Loader=yaml.FullLoader)
     collector_config = CollectorConfig(**cfg)
 
+    if args.command == 'plan':
+        plan(collector_config, args)
+        return
+
     collector = AliyunCollector(collector_config)
-    REGISTRY.register(collector)
+    if collector_config.push is not None:
+        # push mode, the collection runs in the background instead of on scrapes
+        push = dict(collector_config.push)
+        interval = push.pop('interval', 60)
+        PushLoop(collector, RemoteWriter(**push), interval).start()
+        logging.info("Push metrics to {} every {}s".format(push.get('url'), interval))
+    else:
+        REGISTRY.register(collector)
 
-    app = create_app(collector_config)
+    app = create_app(collector_config, collector)
 
     logging.info("Start exporter, listen on {}".format(int(args.port)))
-    httpd = make_server('', int(args.port), app)
+    httpd = make_server('', int(args.port), app, server_class=ThreadingWSGIServer)
     httpd.serve_forever()
 
     try:
@@ -49,3 +78,21 @@ def main():
             time.sleep(5)
     except KeyboardInterrupt:
         pass
+
+
+def plan(config: CollectorConfig, args):
+    interval = args.interval
+    if interval is None:
+        interval = (config.push or {}).get('interval', 60)
+    quotas = dict()
+    for quota in args.quota:
+        product, _, calls = quota.partition('=')
+        quotas[product] = int(calls)
+    collector = AliyunCollector(config) if args.inventory else None
+    try:
+        planner = Planner(config, collector, interval=interval, latency=args.latency, quotas=quotas,
+                          fetch_inventory=args.inventory)
+    except ValueError as e:
+        sys.exit('error: {}'.format(e))
+    plans = planner.plan()
+    print(format_plan(plans, interval, planner.total(plans)))
@@ -0,0 +1,224 @@
+import math
+import sys
+import threading
+import time
+from array import array
+
+measures = ['Average', 'Maximum', 'Minimum']
+aggregations = ['sum', 'avg', 'max', 'min', 'count']
+
+'''
+Columnar storage of the datapoints cached between scrapes.
+
+Holding every datapoint as the parsed JSON dict costs about a kilobyte
+per series. Instead, the label values of a series are interned as a tuple
+in a LabelTable shared by all metrics, and every (project, metric, period)
+keeps its values in PointColumns: one array('d') per measure and an
+array('q') of timestamps, indexed by row. Refreshing a metric overwrites
+the rows in place, rows of series that disappeared are compacted away.
+'''
+
+
+class LabelTable(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = dict()
+        self.tuples = []
+        self.refs = array('q')
+        self.free = []
+
+    def lookup(self, values: tuple):
+        return self.ids.get(values)
+
+    def intern(self, values: tuple) -> int:
+        with self.lock:
+            label_id = self.ids.get(values)
+            if label_id is not None:
+                self.refs[label_id] += 1
+                return label_id
+            values = tuple(sys.intern(v) for v in values)
+            if self.free:
+                label_id = self.free.pop()
+                self.tuples[label_id] = values
+                self.refs[label_id] = 1
+            else:
+                label_id = len(self.tuples)
+                self.tuples.append(values)
+                self.refs.append(1)
+            self.ids[values] = label_id
+            return label_id
+
+    def release(self, label_id: int):
+        with self.lock:
+            self.refs[label_id] -= 1
+            if self.refs[label_id] > 0:
+                return
+            del self.ids[self.tuples[label_id]]
+            self.tuples[label_id] = None
+            self.free.append(label_id)
+
+    def get(self, label_id: int) -> tuple:
+        return self.tuples[label_id]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class PointColumns(object):
+
+    def __init__(self, labels: LabelTable, label_keys, measure_keys):
+        self.labels = labels
+        self.label_keys = tuple(label_keys)
+        self.measure_keys = tuple(measure_keys)
+        self.label_ids = array('q')
+        self.timestamps = array('q')
+        self.columns = {m: array('d') for m in self.measure_keys}
+        self.rows = None
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def find_row(self, position: int, label_id: int):
+        # CloudMonitor returns the series in a stable order, so the row is
+        # usually at the same position, the row index is built only if not.
+        if position < len(self.label_ids) and self.label_ids[position] == label_id:
+            return position
+        if self.rows is None:
+            self.rows = {label_id: row for row, label_id in enumerate(self.label_ids)}
+        return self.rows.get(label_id)
+
+    def update(self, points):
+        seen = array('b', bytes(len(self.label_ids)))
+        for position, point in enumerate(points):
+            values = tuple([str(point[k]) if k in point else '' for k in self.label_keys])
+            label_id = self.labels.lookup(values)
+            row = self.find_row(position, label_id) if label_id is not None else None
+            if row is None:
+                label_id = self.labels.intern(values)
+                row = len(self.label_ids)
+                if self.rows is not None:
+                    self.rows[label_id] = row
+                self.label_ids.append(label_id)
+                self.timestamps.append(0)
+                for column in self.columns.values():
+                    column.append(math.nan)
+                seen.append(0)
+            seen[row] = 1
+            self.timestamps[row] = int(point.get('timestamp', 0))
+            for m, column in self.columns.items():
+                value = point.get(m)
+                column[row] = math.nan if value is None else float(value)
+        if 0 in seen:
+            self.compact(seen)
+        self.rows = None
+
+    def compact(self, keep):
+        label_ids = array('q')
+        timestamps = array('q')
+        columns = {m: array('d') for m in self.measure_keys}
+        for row, label_id in enumerate(self.label_ids):
+            if not keep[row]:
+                self.labels.release(label_id)
+                continue
+            label_ids.append(label_id)
+            timestamps.append(self.timestamps[row])
+            for m, column in columns.items():
+                column.append(self.columns[m][row])
+        self.label_ids = label_ids
+        self.timestamps = timestamps
+        self.columns = columns
+        self.rows = None
+
+    def clear(self):
+        self.compact(bytes(len(self.label_ids)))
+
+    def samples(self, measure: str):
+        '''
+        Yield (label values, value, timestamp in milliseconds) of a measure,
+        series without a value for the measure are skipped.
+        '''
+        column = self.columns.get(measure)
+        if column is None:
+            return
+        for row, label_id in enumerate(self.label_ids):
+            value = column[row]
+            if math.isnan(value):
+                continue
+            yield self.labels.get(label_id), value, self.timestamps[row]
+
+    def aggregate(self, measure: str, by, ops):
+        '''
+        Aggregate a measure over the series grouped by the label keys 'by',
+        computing every op of 'aggregations' in a single pass over the rows.
+        Yield (group label values, {op: value}, latest timestamp).
+        '''
+        column = self.columns.get(measure)
+        if column is None:
+            return
+        positions = [self.label_keys.index(k) if k in self.label_keys else None for k in by]
+        groups = dict()
+        counts = array('q')
+        sums = array('d')
+        lows = array('d')
+        highs = array('d')
+        latest = array('q')
+        for row, label_id in enumerate(self.label_ids):
+            value = column[row]
+            if math.isnan(value):
+                continue
+            values = self.labels.get(label_id)
+            key = tuple([values[p] if p is not None else '' for p in positions])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = len(counts)
+                counts.append(0)
+                sums.append(0.0)
+                lows.append(math.inf)
+                highs.append(-math.inf)
+                latest.append(0)
+            counts[group] += 1
+            sums[group] += value
+            if value < lows[group]:
+                lows[group] = value
+            if value > highs[group]:
+                highs[group] = value
+            if self.timestamps[row] > latest[group]:
+                latest[group] = self.timestamps[row]
+        for key, group in groups.items():
+            results = {'sum': sums[group], 'avg': sums[group] / counts[group], 'max': highs[group],
+                       'min': lows[group], 'count': counts[group]}
+            yield key, {op: results[op] for op in ops}, latest[group]
+
+
+class PointCache(object):
+
+    def __init__(self):
+        self.labels = LabelTable()
+        self.metrics = dict()
+        # the columns of a metric are fetched, updated and read under its lock
+        self.locks_lock = threading.Lock()
+        self.locks = dict()
+        self.updated = dict()
+
+    def lock(self, project: str, metric: str, period: int) -> threading.Lock:
+        with self.locks_lock:
+            return self.locks.setdefault((project, metric, period), threading.Lock())
+
+    def updated_at(self, project: str, metric: str, period: int) -> float:
+        return self.updated.get((project, metric, period), 0)
+
+    def get(self, project: str, metric: str, period: int) -> PointColumns:
+        return self.metrics.get((project, metric, period))
+
+    def update(self, project: str, metric: str, period: int, points, label_keys, measure_keys) -> PointColumns:
+        key = (project, metric, period)
+        columns = self.metrics.get(key)
+        if columns is None or columns.label_keys != tuple(label_keys) or columns.measure_keys != tuple(measure_keys):
+            if columns is not None:
+                columns.clear()
+            columns = PointColumns(self.labels, label_keys, measure_keys)
+            self.metrics[key] = columns
+        columns.update(points)
+        self.updated[key] = time.time()
+        return columns
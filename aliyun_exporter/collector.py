@@ -1,24 +1,23 @@
-import json
 import logging
+import threading
 import time
 import os
 
-from datetime import datetime, timedelta
+from collections import Counter, OrderedDict, namedtuple
+from copy import copy
+from functools import partial
 from prometheus_client import Summary
 from prometheus_client.core import GaugeMetricFamily, REGISTRY
 from aliyunsdkcore.client import AcsClient
-# from aliyunsdkcms.request.v20190101 import QueryMetricLastRequest
-from aliyunsdkcms.request.v20190101 import DescribeMetricLastRequest
-from aliyunsdkrds.request.v20140815 import DescribeDBInstancePerformanceRequest
 from ratelimiter import RateLimiter
 
-from aliyun_exporter.info_provider import InfoProvider
-from aliyun_exporter.utils import try_or_else
-
-rds_performance = 'rds_performance'
-special_projects = {
-    rds_performance: lambda collector: RDSPerformanceCollector(collector),
-}
+from aliyun_exporter.cache import PointCache, aggregations, measures
+from aliyun_exporter.decoder import decode_datapoints
+from aliyun_exporter.info_provider import InfoProvider, info_metric_name, resource_product
+from aliyun_exporter.limiter import AdaptiveController, CircuitOpenError
+from aliyun_exporter.performance import special_projects
+from aliyun_exporter.scheduler import DeadlineExceeded, FairScheduler, time_left
+from aliyun_exporter.utils import count_drops, lazy_import, import_duration_gauge, SeriesGuard
 
 requestSummary = Summary('cloudmonitor_request_latency_seconds', 'CloudMonitor request latency', ['project'])
 requestFailedSummary = Summary('cloudmonitor_failed_request_latency_seconds', 'CloudMonitor failed request latency',
@@ -33,55 +32,251 @@ class CollectorConfig(object):
                  metrics=None,
                  info_metrics=None,
                  do_info_region=None,
+                 info_labels=None,
+                 max_series=None,
+                 scrape_timeout=None,
+                 adaptive=None,
+                 inventory_ttl=600,
+                 performance=None,
+                 push=None,
+                 accounts=None,
+                 name=None,
                  ):
         # if metrics is None:
         # raise Exception('Metrics config must be set.')
 
+        self.name = name
+        self.pool_size = pool_size
+        self.scrape_timeout = scrape_timeout
         self.credential = credential
         self.metrics = metrics
         self.rate_limit = rate_limit
         self.info_metrics = info_metrics
         self.do_info_region = do_info_region
+        self.info_labels = info_labels
+        self.max_series = max_series
+        self.adaptive = dict(max_concurrency=pool_size)
+        self.adaptive.update(adaptive or {})
+        self.inventory_ttl = inventory_ttl
+        self.performance = performance if performance is not None else {}
+        self.push = push
 
-        # ENV
-        access_id = os.environ.get('ALIYUN_ACCESS_ID')
-        access_secret = os.environ.get('ALIYUN_ACCESS_SECRET')
-        region = os.environ.get('ALIYUN_REGION')
+        # Every account inherits the top-level settings it does not override,
+        # the top-level credential is not used in this case.
+        self.accounts = None
+        if accounts is not None:
+            defaults = dict(pool_size=pool_size, rate_limit=rate_limit, metrics=metrics, info_metrics=info_metrics,
+                            do_info_region=do_info_region, info_labels=info_labels, max_series=max_series,
+                            adaptive=adaptive, inventory_ttl=inventory_ttl, performance=performance)
+            self.accounts = []
+            for account in accounts:
+                if 'name' not in account:
+                    raise Exception('name must be set in account item.')
+                self.accounts.append(CollectorConfig(**dict(defaults, **account)))
+            return
 
         if self.credential is None:
             self.credential = {}
-        if access_id is not None and len(access_id) > 0:
-            self.credential['access_key_id'] = access_id
-        if access_secret is not None and len(access_secret) > 0:
-            self.credential['access_key_secret'] = access_secret
-        if region is not None and len(region) > 0:
-            self.credential['region_id'] = region
-        if self.credential['access_key_id'] is None or \
-                self.credential['access_key_secret'] is None:
+
+        # ENV, only applies to the default account
+        if name is None:
+            access_id = os.environ.get('ALIYUN_ACCESS_ID')
+            access_secret = os.environ.get('ALIYUN_ACCESS_SECRET')
+            region = os.environ.get('ALIYUN_REGION')
+
+            if access_id is not None and len(access_id) > 0:
+                self.credential['access_key_id'] = access_id
+            if access_secret is not None and len(access_secret) > 0:
+                self.credential['access_key_secret'] = access_secret
+            if region is not None and len(region) > 0:
+                self.credential['region_id'] = region
+        if self.credential.get('access_key_id') is None or \
+                self.credential.get('access_key_secret') is None:
             raise Exception('Credential is not fully configured.')
 
 
+'''
+Selection is the slice of the work a scrape asks for, see 'from_params'
+for the query parameters of /metrics.
+
+Selecting projects leaves out the info metrics and selecting resources
+leaves out the projects, unless both are selected.
+'''
+
+
+class Selection(object):
+    info_values = ['only', 'exclude']
+
+    def __init__(self, projects=None, resources=None, accounts=None, info=None):
+        if info is not None and info not in self.info_values:
+            raise ValueError('info must be one of {}'.format(self.info_values))
+        self.projects = None if projects is None else frozenset(projects)
+        self.resources = None if resources is None else frozenset(resources)
+        self.accounts = None if accounts is None else frozenset(accounts)
+        self.info = info
+
+    @staticmethod
+    def from_params(params: dict):
+        '''
+        Build a selection from parsed query parameters, 'project', 'resource'
+        and 'account' may be repeated, 'info' is 'only' or 'exclude'.
+        '''
+        info = params.get('info')
+        return Selection(projects=params.get('project'),
+                         resources=params.get('resource'),
+                         accounts=params.get('account'),
+                         info=info[0] if info else None)
+
+    def key(self):
+        return self.projects, self.resources, self.accounts, self.info
+
+    def has_project(self, project):
+        if self.info == 'only':
+            return False
+        if self.projects is None:
+            return self.resources is None
+        return project in self.projects
+
+    def has_resource(self, resource):
+        if self.info == 'exclude':
+            return False
+        if self.resources is None:
+            return self.projects is None or self.info == 'only'
+        return resource in self.resources
+
+    def has_account(self, account):
+        return self.accounts is None or account is None or account in self.accounts
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+'''
+AliyunCollector collects every configured account on a shared FairScheduler.
+
+When the 'accounts' section is configured, all series carry an 'account'
+label and families of the same name are merged across accounts.
+
+Concurrent collections of the same selection are coalesced: the first one
+runs, the others wait for and share its result.
+'''
+
+
 class AliyunCollector(object):
     def __init__(self, config: CollectorConfig):
         self.config = config
-        self.metrics = config.metrics
+        self.scheduler = FairScheduler(config.pool_size)
+        if config.accounts is not None:
+            self.accounts = OrderedDict((c.name, AccountCollector(c, timestamps=config.push is not None))
+                                        for c in config.accounts)
+        else:
+            self.accounts = OrderedDict([(None, AccountCollector(config, timestamps=config.push is not None))])
+        self.flights_lock = threading.Lock()
+        self.flights = dict()
+
+    def collect(self, selection: Selection = None):
+        selection = selection if selection is not None else Selection()
+        key = selection.key()
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if leader:
+            try:
+                flight.result = list(self.collect_selection(selection))
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self.flights_lock:
+                    del self.flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        yield from flight.result
+
+    def collect_selection(self, selection: Selection):
+        tasks = OrderedDict((name, account.tasks(selection)) for name, account in self.accounts.items()
+                            if selection.has_account(name))
+        # drops are counted per collection, concurrent ones share the guards
+        dropped = dict((name, dict()) for name in tasks)
+        tasks = OrderedDict((name, [partial(count_drops, t, dropped[name]) for t in account_tasks])
+                            for name, account_tasks in tasks.items())
+        skipped = Counter()
+        families = OrderedDict()
+        # the push loop is not scraped, its collections are not bound to a scrape timeout
+        timeout = self.config.scrape_timeout if self.config.push is None else None
+        for name, result in self.scheduler.run(tasks, timeout, skipped):
+            merge_families(families, name, result)
+        for name, account in self.accounts.items():
+            if not selection.has_account(name):
+                continue
+            merge_families(families, name, [account.series_guard.dropped_gauge(dropped[name]),
+                                            GaugeMetricFamily('aliyun_exporter_skipped_tasks',
+                                                              'Tasks skipped by the scrape_timeout.',
+                                                              value=skipped[name])])
+            merge_families(families, name, account.controller.gauges())
+        yield from families.values()
+        yield import_duration_gauge()
+
+
+def merge_families(families: OrderedDict, account, result):
+    # families may be cached by the collectors, they are never modified
+    for family in result:
+        samples = family.samples
+        if account is not None:
+            samples = [s._replace(labels=dict(s.labels, account=account)) for s in samples]
+        merged = families.get(family.name)
+        if merged is None:
+            merged = families[family.name] = copy(family)
+            merged.samples = list(samples)
+        else:
+            merged.samples.extend(samples)
+
+
+class AccountCollector(object):
+    def __init__(self, config: CollectorConfig, timestamps=False):
+        self.config = config
+        # attach the CloudMonitor timestamps to the samples, used in push mode
+        self.timestamps = timestamps
+        self.metrics = config.metrics if config.metrics is not None else {}
+        # parsed once, an invalid metric item fails at startup rather than every scrape
+        self.metric_groups = OrderedDict((project, group_metrics(items)) for project, items in self.metrics.items()
+                                         if project not in special_projects)
         self.info_metrics = config.info_metrics
         self.client = AcsClient(
             ak=config.credential['access_key_id'],
             secret=config.credential['access_key_secret'],
             timeout=10,
             connect_timeout=10,
-            max_retry_time=2
+            max_retry_time=2,
+            pool_size=config.pool_size,
             # region_id=config.credential['region_id'] #在获取监控指标metrics时貌似不需要region
         )
+        self.clients = dict()
         self.rateLimiter = RateLimiter(max_calls=config.rate_limit)
+        self.controller = AdaptiveController(**config.adaptive)
+        self.info_cache = dict()
+        self.inventory = dict()
+        self.series_guard = SeriesGuard(config.max_series)
+        self.point_cache = PointCache()
         self.info_provider = InfoProvider(ak=config.credential['access_key_id'],
                                           secret=config.credential['access_key_secret'],
-                                          region_id=config.credential['region_id'])
+                                          region_id=config.credential.get('region_id'),
+                                          info_labels=config.info_labels,
+                                          series_guard=self.series_guard,
+                                          controller=self.controller)
         self.special_collectors = dict()
         for k, v in special_projects.items():
             if k in self.metrics:
-                self.special_collectors[k] = v(self)
+                self.special_collectors[k] = v(self, k, **config.performance)
 
     def query_metric(self, project: str, metric: str, period: int):
         with self.rateLimiter:
@@ -89,6 +284,7 @@ class AliyunCollector(object):
             # req.set_Project(project)
             # req.set_Metric(metric)
             # req.set_Period(period)
+            DescribeMetricLastRequest = lazy_import('aliyunsdkcms.request.v20190101.DescribeMetricLastRequest')
             req = DescribeMetricLastRequest.DescribeMetricLastRequest()
             req.set_Namespace(project)
             req.set_MetricName(metric)
@@ -107,8 +303,15 @@ class AliyunCollector(object):
                 try:
                     if resp_count > 1:
                         logging.error("上次请求失败，正在进行第{}次请求".format(resp_count))
+                        left = time_left()
+                        if left is not None and left <= 5:
+                            raise DeadlineExceeded('Scrape budget exhausted retrying {}_{}'.format(project, metric))
                         time.sleep(5)
-                    resp = self.client.do_action_with_exception(req)
+                    resp = self.controller.call(req.get_product(), self.config.credential.get('region_id'),
+                                                lambda: self.client.do_action_with_exception(req))
+                except (CircuitOpenError, DeadlineExceeded):
+                    requestFailedSummary.labels(project).observe(time.time() - start_time)
+                    raise
                 except Exception as e:
                     logging.error('Error request cloud monitor api', exc_info=e)
                     resp_count += 1
@@ -130,10 +333,8 @@ class AliyunCollector(object):
             #         return []
             # else:
             #     requestSummary.labels(project).observe(time.time() - start_time)
-        data = json.loads(resp)
-        # print(data)
-        if 'Datapoints' in data:
-            points = json.loads(data['Datapoints'])
+        points = decode_datapoints(resp)
+        if points is not None:
             return points
         else:
             logging.error(
@@ -142,157 +343,282 @@ class AliyunCollector(object):
             return None
 
     def parse_label_keys(self, point):
-        return [k for k in point if k not in ['timestamp', 'Maximum', 'Minimum', 'Average']]
+        return [k for k in point if k != 'timestamp' and k not in measures]
 
     def format_metric_name(self, project, name):
         return 'aliyun_{}_{}'.format(project, name)
 
-    def metric_generator(self, project, metric):
-        if 'name' not in metric:
-            raise Exception('name must be set in metric item.')
-        name = metric['name']
-        metric_name = metric['name']
-        period = 60
-        measure = 'Average'
-        if 'rename' in metric:
-            name = metric['rename']
-        if 'period' in metric:
-            period = metric['period']
-        if 'measure' in metric:
-            measure = metric['measure']
+    def metrics_generator(self, project, specs):
+        '''
+        Fetch a metric once and emit every config entry of it, the entries
+        must share the same metric name and period, see group_metrics.
+
+        Concurrent collections of a metric are serialized on its lock in the
+        point cache. A collection which waited for another one to fetch the
+        metric serves the columns it fetched instead of fetching again.
+        '''
+        metric_name = specs[0].metric_name
+        period = specs[0].period
+        requested_at = time.time()
+        with self.point_cache.lock(project, metric_name, period):
+            if self.point_cache.updated_at(project, metric_name, period) >= requested_at:
+                columns = self.point_cache.get(project, metric_name, period)
+                families = []
+                for spec in specs:
+                    families.extend(self.columns_gauges(project, spec, columns))
+                    families.append(metric_up_gauge(self.format_metric_name(project, spec.name), True))
+            else:
+                families = list(self.fetch_generator(project, specs))
+        yield from families
+
+    def fetch_generator(self, project, specs):
+        metric_name = specs[0].metric_name
+        period = specs[0].period
+        requested = []
+        for spec in specs:
+            requested.extend(m for m in spec.measures if m not in requested)
 
         try:
             points = self.query_metric(project, metric_name, period)
+        except CircuitOpenError as e:
+            logging.warning('{}, serve last known {}_{}'.format(e, project, metric_name))
+            columns = self.point_cache.get(project, metric_name, period)
+            for spec in specs:
+                if columns is not None:
+                    yield from self.columns_gauges(project, spec, columns)
+                yield metric_up_gauge(self.format_metric_name(project, spec.name), False)
+            return
         except Exception as e:
             logging.error('Error query metrics for {}_{}'.format(project, metric_name), exc_info=e)
-            yield metric_up_gauge(self.format_metric_name(project, name), False)
-            return
-        if points is None:
-            yield metric_up_gauge(self.format_metric_name(project, name), False)
-            return
-        if len(points) < 1:
-            yield metric_up_gauge(self.format_metric_name(project, name), False)
+            points = None
+        if points is None or len(points) < 1:
+            for spec in specs:
+                yield metric_up_gauge(self.format_metric_name(project, spec.name), False)
             return
         label_keys = self.parse_label_keys(points[0])
-        gauge = GaugeMetricFamily(self.format_metric_name(project, name), '', labels=label_keys)
-        for point in points:
-            gauge.add_metric([try_or_else(lambda: str(point[k]), '') for k in label_keys], point[measure])
-        yield gauge
-        yield metric_up_gauge(self.format_metric_name(project, name), True)
-
-    def collect(self):
-        for project in self.metrics:
-            if project in special_projects:
-                continue
-            for metric in self.metrics[project]:
-                yield from self.metric_generator(project, metric)
-        if self.info_metrics != None:
-            for resource in self.info_metrics:
-                if self.config.do_info_region == None:
-                    client = AcsClient(
-                        ak=self.config.credential['access_key_id'],
-                        secret=self.config.credential['access_key_secret'],
-                        region_id=self.config.credential['region_id'],
-                        timeout=10,
-                        connect_timeout=10,
-                        max_retry_time=2,
-                    )
-                    t_metrice = self.info_provider.get_metrics(resource, client)
-                    if t_metrice == None:
-                        continue
-                    else:
-                        yield t_metrice
-                else:
-                    for a_region in self.config.do_info_region:
-                        client = AcsClient(
-                            ak=self.config.credential['access_key_id'],
-                            secret=self.config.credential['access_key_secret'],
-                            region_id=a_region,
-                            timeout=10,
-                            connect_timeout=10,
-                            max_retry_time=2,
-                        )
-                        t_metrice = self.info_provider.get_metrics(resource, client)
-                        if t_metrice == None:
-                            continue
-                        else:
-                            yield t_metrice
-        for v in self.special_collectors.values():
-            yield from v.collect()
+        measure_keys = [m for m in measures if m in points[0] and m not in requested] + requested
+        columns = self.point_cache.update(project, metric_name, period, points, label_keys, measure_keys)
+        del points  # the columns hold everything needed from here on
+        for spec in specs:
+            yield from self.columns_gauges(project, spec, columns)
+            yield metric_up_gauge(self.format_metric_name(project, spec.name), True)
 
+    def columns_gauges(self, project, spec, columns):
+        if spec.measure_label:
+            if not spec.drop_raw:
+                gauge = GaugeMetricFamily(self.format_metric_name(project, spec.name), '',
+                                          labels=columns.label_keys + ('measure',))
+                for measure in spec.measures:
+                    for label_values, value, timestamp in columns.samples(measure):
+                        self.series_guard.add_metric(gauge, label_values + (measure,), value,
+                                                     self.timestamp(timestamp))
+                yield gauge
+            for rule in spec.aggregate:
+                yield from self.aggregate_gauges(project, rule.name or spec.name, columns, rule, spec.measures, True)
+            return
+        for measure in spec.measures:
+            name = '{}_{}'.format(spec.name, measure) if spec.suffix else spec.name
+            if not spec.drop_raw:
+                yield self.columns_gauge(project, name, columns, measure)
+            for rule in spec.aggregate:
+                prefix = name if rule.name is None else rule.name + name[len(spec.name):]
+                yield from self.aggregate_gauges(project, prefix, columns, rule, [measure])
 
-def metric_up_gauge(resource: str, succeeded=True):
-    metric_name = resource + '_up'
-    description = 'Did the {} fetch succeed.'.format(resource)
-    return GaugeMetricFamily(metric_name, description, value=int(succeeded))
-
+    def aggregate_gauges(self, project, name, columns, rule, measures, measure_label=False):
+        label_names = list(rule.by) + (['measure'] if measure_label else [])
+        gauges = OrderedDict((op, GaugeMetricFamily(self.format_metric_name(project, '{}_{}'.format(name, op)), '',
+                                                    labels=label_names)) for op in rule.ops)
+        for measure in measures:
+            extra = (measure,) if measure_label else ()
+            for label_values, values, timestamp in columns.aggregate(measure, rule.by, rule.ops):
+                for op, value in values.items():
+                    self.series_guard.add_metric(gauges[op], label_values + extra, value, self.timestamp(timestamp))
+        yield from gauges.values()
 
-class RDSPerformanceCollector:
+    def columns_gauge(self, project, name, columns, measure):
+        gauge = GaugeMetricFamily(self.format_metric_name(project, name), '', labels=columns.label_keys)
+        for label_values, value, timestamp in columns.samples(measure):
+            self.series_guard.add_metric(gauge, label_values, value, self.timestamp(timestamp))
+        return gauge
 
-    def __init__(self, delegate: AliyunCollector):
-        self.parent = delegate
+    def timestamp(self, timestamp_ms):
+        if not self.timestamps or timestamp_ms <= 0:
+            return None
+        return timestamp_ms / 1000
 
-    def collect(self):
-        if self.parent.config.do_info_region == None:
-            client = AcsClient(
-                ak=self.parent.config.credential['access_key_id'],
-                secret=self.parent.config.credential['access_key_secret'],
-                region_id=self.parent.config.credential['region_id'],
+    def get_client(self, region: str) -> AcsClient:
+        # clients are kept for the connection pools of their sessions
+        client = self.clients.get(region)
+        if client is None:
+            client = self.clients.setdefault(region, AcsClient(
+                ak=self.config.credential['access_key_id'],
+                secret=self.config.credential['access_key_secret'],
+                region_id=region,
                 timeout=10,
                 connect_timeout=10,
                 max_retry_time=2,
-            )
-            for id in [s.labels['DBInstanceId'] for s in self.parent.info_provider.get_metrics('rds', client).samples]:
-                metrics = self.query_rds_performance_metrics(id)
-                for metric in metrics:
-                    yield from self.parse_rds_performance(id, metric)
+                pool_size=self.config.pool_size,
+            ))
+        return client
 
-        else:
-            for a_region in self.parent.config.do_info_region:
-                client = AcsClient(
-                    ak=self.parent.config.credential['access_key_id'],
-                    secret=self.parent.config.credential['access_key_secret'],
-                    region_id=a_region,
-                    timeout=10,
-                    connect_timeout=10,
-                    max_retry_time=2,
-                )
-                for id in [s.labels['DBInstanceId'] for s in
-                           self.parent.info_provider.get_metrics('rds', client).samples]:
-                    metrics = self.query_rds_performance_metrics(id)
-                    for metric in metrics:
-                        yield from self.parse_rds_performance(id, metric)
-
-    def parse_rds_performance(self, id, value):
-        value_format: str = value['ValueFormat']
-        metric_name = value['Key']
-        keys = ['value']
-        if value_format is not None and '&' in value_format:
-            keys = value_format.split('&')
-        metric = value['Values']['PerformanceValue']
-        if len(metric) < 1:
-            return
-        values = metric[0]['Value'].split('&')
-        for k, v in zip(keys, values):
-            gauge = GaugeMetricFamily(
-                self.parent.format_metric_name(rds_performance, metric_name + '_' + k),
-                '', labels=['instanceId'])
-            gauge.add_metric([id], float(v))
-            yield gauge
+    def info_regions(self):
+        return info_regions(self.config)
 
-    def query_rds_performance_metrics(self, id):
-        req = DescribeDBInstancePerformanceRequest.DescribeDBInstancePerformanceRequest()
-        req.set_DBInstanceId(id)
-        req.set_Key(','.join([metric['name'] for metric in self.parent.metrics[rds_performance]]))
-        now = datetime.utcnow()
-        now_str = now.replace(second=0, microsecond=0).strftime("%Y-%m-%dT%H:%MZ")
-        one_minute_ago_str = (now - timedelta(minutes=1)).replace(second=0, microsecond=0).strftime("%Y-%m-%dT%H:%MZ")
-        req.set_StartTime(one_minute_ago_str)
-        req.set_EndTime(now_str)
+    def info_generator(self, resource, region):
+        product = resource_product(resource)
         try:
-            resp = self.parent.client.do_action_with_exception(req)
+            if product is not None and self.controller.is_open(product, region):
+                raise CircuitOpenError(product, region)
+            gauge = self.info_provider.get_metrics(resource, self.get_client(region))
         except Exception as e:
-            logging.error('Error request rds performance api', exc_info=e)
-            return []
-        data = json.loads(resp)
-        return data['PerformanceKeys']['PerformanceKey']
+            # a failed or partial listing is not cached, the last complete one is served
+            if isinstance(e, CircuitOpenError):
+                logging.warning('{}, serve last known {} info'.format(e, resource))
+            else:
+                logging.error('Error listing {} in {}, serve last known info'.format(resource, region), exc_info=e)
+            gauge = self.info_cache.get((resource, region))
+            if gauge is not None:
+                yield gauge
+            yield info_up_gauge(resource, region, False)
+            return
+        if gauge is not None:
+            self.info_cache[(resource, region)] = gauge
+            self.update_inventory(resource, region, gauge, self.info_provider.info_labels.get(resource) or {},
+                                  self.series_guard)
+            yield gauge
+        yield info_up_gauge(resource, region, True)
+
+    def update_inventory(self, resource, region, gauge, labels, series_guard):
+        # a truncated info metric does not list every instance
+        if series_guard.truncated(gauge):
+            return
+        rename = dict((v, k) for k, v in (labels.get('rename') or {}).items())
+        instances = [dict((rename.get(k, k), v) for k, v in s.labels.items()) for s in gauge.samples]
+        self.inventory[(resource, region)] = (time.time(), instances)
+
+    def instance_ids(self, resource, id_key, region):
+        '''
+        IDs of the instances of a resource in a region. The inventory is
+        cached for 'inventory_ttl' seconds, collecting the info metric of
+        the resource refreshes it as well. The last known inventory is
+        used if the resource cannot be listed.
+        '''
+        entry = self.inventory.get((resource, region))
+        fresh = entry is not None and time.time() - entry[0] < self.config.inventory_ttl
+        if not fresh or any(id_key not in instance for instance in entry[1]):
+            try:
+                guard = SeriesGuard()
+                gauge = self.info_provider.get_metrics(resource, self.get_client(region),
+                                                       labels={'include': [id_key]}, series_guard=guard)
+                if gauge is not None:
+                    self.update_inventory(resource, region, gauge, {}, guard)
+            except (CircuitOpenError, DeadlineExceeded) as e:
+                logging.warning('{}, use last known {} inventory'.format(e, resource))
+            except Exception as e:
+                logging.error('Error listing {} in {}, use last known inventory'.format(resource, region),
+                              exc_info=e)
+            entry = self.inventory.get((resource, region), entry)
+            if entry is None:
+                return []
+        return [instance[id_key] for instance in entry[1] if id_key in instance]
+
+    def tasks(self, selection: Selection):
+        tasks = []
+        for project, groups in self.metric_groups.items():
+            if not selection.has_project(project):
+                continue
+            for specs in groups:
+                tasks.append(partial(self.metrics_generator, project, specs))
+        if self.info_metrics is not None:
+            for resource in self.info_metrics:
+                if not selection.has_resource(resource):
+                    continue
+                for region in self.info_regions():
+                    tasks.append(partial(self.info_generator, resource, region))
+        for k, v in self.special_collectors.items():
+            if selection.has_project(k):
+                tasks.extend(v.tasks())
+        return tasks
+
+
+MetricSpec = namedtuple('MetricSpec', ['name', 'metric_name', 'period', 'measures', 'suffix', 'measure_label',
+                                       'aggregate', 'drop_raw'])
+AggregateRule = namedtuple('AggregateRule', ['name', 'by', 'ops'])
+
+
+def parse_metric(metric) -> MetricSpec:
+    '''
+    Parse a metric item of the config. With 'measures', one gauge per measure
+    is emitted, named '<name>_<measure>', or a single gauge with a 'measure'
+    label if 'measure_label' is set. 'aggregate' rules add a gauge per op
+    named '<name>_<op>', 'drop_raw' leaves out the series they aggregate.
+    '''
+    if 'name' not in metric:
+        raise Exception('name must be set in metric item.')
+    name = metric.get('rename', metric['name'])
+    period = metric.get('period', 60)
+    aggregate = parse_aggregate(metric.get('aggregate'))
+    drop_raw = metric.get('drop_raw', False)
+    if drop_raw and len(aggregate) < 1:
+        raise Exception('drop_raw of {} requires aggregate rules.'.format(metric['name']))
+    # rules sharing a name and an op would emit the same family with different labels
+    generated = set()
+    for rule in aggregate:
+        for op in rule.ops:
+            key = (rule.name or name, op)
+            if key in generated:
+                raise Exception('aggregate rules of {} generate {}_{} twice, name them apart.'.format(
+                    metric['name'], key[0], op))
+            generated.add(key)
+    if 'measures' in metric:
+        return MetricSpec(name, metric['name'], period, list(metric['measures']), True,
+                          metric.get('measure_label', False), aggregate, drop_raw)
+    return MetricSpec(name, metric['name'], period, [metric.get('measure', 'Average')], False, False,
+                      aggregate, drop_raw)
+
+
+def parse_aggregate(rules):
+    if rules is None:
+        return []
+    if isinstance(rules, dict):
+        rules = [rules]
+    result = []
+    for rule in rules:
+        ops = rule.get('ops', ['avg'])
+        for op in ops:
+            if op not in aggregations:
+                raise Exception('op of aggregate rule must be one of {}.'.format(aggregations))
+        result.append(AggregateRule(rule.get('name'), list(rule.get('by', [])), list(ops)))
+    return result
+
+
+def group_metrics(metrics):
+    '''
+    Parse the metric items and group their specs by (metric name, period),
+    items of a group are fetched by a single API call.
+    '''
+    groups = OrderedDict()
+    for metric in metrics:
+        spec = parse_metric(metric)
+        groups.setdefault((spec.metric_name, spec.period), []).append(spec)
+    return list(groups.values())
+
+
+def info_regions(config: CollectorConfig):
+    if config.do_info_region is None:
+        return [config.credential.get('region_id')]
+    return config.do_info_region
+
+
+def metric_up_gauge(resource: str, succeeded=True):
+    metric_name = resource + '_up'
+    description = 'Did the {} fetch succeed.'.format(resource)
+    return GaugeMetricFamily(metric_name, description, value=int(succeeded))
+
+
+def info_up_gauge(resource: str, region, succeeded=True):
+    # info metrics are collected per region, the region tells the samples apart
+    metric_name = info_metric_name(resource) + '_up'
+    gauge = GaugeMetricFamily(metric_name, 'Did the {} info fetch succeed.'.format(resource), labels=['region'])
+    gauge.add_metric([str(region)], int(succeeded))
+    return gauge
@@ -0,0 +1,27 @@
+import pytest
+
+from aliyun_exporter.collector import AliyunCollector, CollectorConfig
+
+
+@pytest.fixture
+def credential():
+    return {'access_key_id': 'id', 'access_key_secret': 'secret', 'region_id': 'cn-hangzhou'}
+
+
+@pytest.fixture
+def make_collector(credential):
+    '''
+    Build an AliyunCollector from CollectorConfig keywords, with the test
+    credential unless the config sets one. With 'points', every account
+    answers the metric queries with these datapoints, or with the result
+    of 'points(project, metric, period)' if it is callable.
+    '''
+    def make(points=None, **config):
+        config.setdefault('credential', dict(credential))
+        collector = AliyunCollector(CollectorConfig(**config))
+        if points is not None:
+            query = points if callable(points) else lambda project, metric, period: [dict(p) for p in points]
+            for account in collector.accounts.values():
+                account.query_metric = query
+        return collector
+    return make
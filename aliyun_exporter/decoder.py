@@ -0,0 +1,82 @@
+import json
+
+'''
+Decoders of the API responses.
+
+A fast JSON library (orjson or ujson) is used when installed, the standard
+json module otherwise. The fast libraries decode the bytes returned by
+the SDK directly, without an intermediate str copy.
+
+DescribeMetricLast returns its datapoints as a JSON string embedded in the
+JSON response, the string is popped out of the envelope so that it can be
+released as soon as it is decoded. Inventory pages are decoded in full,
+the JSON libraries cannot skip fields, and then projected to the fields
+needed for labels, so that nested attributes do not outlive the page.
+'''
+
+try:
+    import orjson
+
+    backend = 'orjson'
+    loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        backend = 'ujson'
+        loads = ujson.loads
+    except ImportError:
+        backend = 'json'
+        loads = json.loads
+
+
+def decode(resp):
+    return loads(resp)
+
+
+def decode_datapoints(resp):
+    '''
+    Decode a DescribeMetricLast response, return None if the response
+    does not have the Datapoints field.
+    '''
+    data = loads(resp)
+    datapoints = data.pop('Datapoints', None)
+    del data
+    if datapoints is None:
+        return None
+    if isinstance(datapoints, list):
+        return datapoints
+    return loads(datapoints)
+
+
+def decode_page(resp, to_list, project=None):
+    instances = to_list(loads(resp))
+    if project is None:
+        return instances
+    return [project(instance) for instance in instances]
+
+
+def benchmark(series=100000, rounds=5):
+    '''
+    Time the decoding of a DescribeMetricLast response of 'series'
+    datapoints with the json module and the selected backend, return
+    {backend: seconds per response}.
+    '''
+    import random
+    import time
+    datapoints = [{'timestamp': 1548777660000, 'userId': '1234567890123456', 'instanceId': 'i-bp1{:012d}'.format(i),
+                   'device': '/dev/vda1', 'Maximum': random.random() * 100, 'Minimum': random.random(),
+                   'Average': random.random() * 50} for i in range(series)]
+    resp = json.dumps({'Code': '200', 'Period': '60', 'RequestId': 'request-id',
+                       'Datapoints': json.dumps(datapoints)}).encode('utf-8')
+
+    def stdlib(body):
+        return json.loads(json.loads(body)['Datapoints'])
+
+    results = dict()
+    for name, op in (('json', stdlib), (backend, decode_datapoints)):
+        start_time = time.time()
+        for _ in range(rounds):
+            op(resp)
+        results[name] = (time.time() - start_time) / rounds
+    return results
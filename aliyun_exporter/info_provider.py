@@ -1,26 +1,74 @@
-import json
 import time
-from collections import Iterable
+from collections import Iterable, namedtuple
+from copy import copy
 
 from aliyunsdkcore.client import AcsClient
 from cachetools import cached, TTLCache
 from prometheus_client.metrics_core import GaugeMetricFamily
 
-import aliyunsdkecs.request.v20140526.DescribeInstancesRequest as DescribeECS
-import aliyunsdkrds.request.v20140815.DescribeDBInstancesRequest as DescribeRDS
-import aliyunsdkr_kvstore.request.v20150101.DescribeInstancesRequest as DescribeRedis
-import aliyunsdkslb.request.v20140515.DescribeLoadBalancersRequest as DescribeSLB
-import aliyunsdkdds.request.v20151201.DescribeDBInstancesRequest as Mongodb
-import aliyunsdkpolardb.request.v20170801.DescribeDBClustersRequest as Polardb
-import oss2
+from aliyun_exporter.decoder import decode_page
+from aliyun_exporter.limiter import CircuitOpenError
+from aliyun_exporter.scheduler import DeadlineExceeded
+from aliyun_exporter.utils import try_or_else, lazy_import, SeriesGuard
 
-from aliyunsdkdts.request.v20200101 import DescribeMigrationJobsRequest, DescribeSynchronizationJobsRequest
-from aliyunsdkdts.request.v20200101 import DescribeSubscriptionInstancesRequest
-from aliyunsdkons.request.v20190214 import OnsInstanceInServiceListRequest
-from aliyunsdkelasticsearch.request.v20170613 import ListInstanceRequest as ElasticSearch
-# from aliyunsdkvpc.request.v20160428 import DescribeEipAddressesRequest
+'''
+Resource handlers, keyed by the resource name used in 'info_metrics'.
+
+The SDK module of a resource is imported when the resource is collected
+for the first time, resources that are not configured cost nothing.
+'''
+ResourceHandler = namedtuple('ResourceHandler', ['info', 'module', 'request'])
+
+resource_handlers = {
+    'ecs': ResourceHandler('ecs_info', 'aliyunsdkecs.request.v20140526.DescribeInstancesRequest',
+                           'DescribeInstancesRequest'),
+    'rds': ResourceHandler('rds_info', 'aliyunsdkrds.request.v20140815.DescribeDBInstancesRequest',
+                           'DescribeDBInstancesRequest'),
+    'redis': ResourceHandler('redis_info', 'aliyunsdkr_kvstore.request.v20150101.DescribeInstancesRequest',
+                             'DescribeInstancesRequest'),
+    'slb': ResourceHandler('slb_info', 'aliyunsdkslb.request.v20140515.DescribeLoadBalancersRequest',
+                           'DescribeLoadBalancersRequest'),
+    'mongodb': ResourceHandler('mongodb_info', 'aliyunsdkdds.request.v20151201.DescribeDBInstancesRequest',
+                               'DescribeDBInstancesRequest'),
+    'polardb': ResourceHandler('polardb_info', 'aliyunsdkpolardb.request.v20170801.DescribeDBClustersRequest',
+                               'DescribeDBClustersRequest'),
+    'oss': ResourceHandler('oss_info', 'oss2', None),
+    'dts_migration': ResourceHandler('dts_migration_info',
+                                     'aliyunsdkdts.request.v20200101.DescribeMigrationJobsRequest',
+                                     'DescribeMigrationJobsRequest'),
+    'dts_subcription': ResourceHandler('dts_subscription_info',
+                                       'aliyunsdkdts.request.v20200101.DescribeSubscriptionInstancesRequest',
+                                       'DescribeSubscriptionInstancesRequest'),
+    'dts_synchroniza': ResourceHandler('dts_synchroniza_info',
+                                       'aliyunsdkdts.request.v20200101.DescribeSynchronizationJobsRequest',
+                                       'DescribeSynchronizationJobsRequest'),
+    'mq': ResourceHandler('mq_info', 'aliyunsdkons.request.v20190214.OnsInstanceInServiceListRequest',
+                          'OnsInstanceInServiceListRequest'),
+    'elasticsearch': ResourceHandler('elasticsearch_info', 'aliyunsdkelasticsearch.request.v20170613.ListInstanceRequest',
+                                     'ListInstanceRequest'),
+    # 'eip': ResourceHandler('eip_info', 'aliyunsdkvpc.request.v20160428.DescribeEipAddressesRequest',
+    #                        'DescribeEipAddressesRequest'),
+}
+
+
+# errors of the pagers which are not retried, the listing would be incomplete
+not_retried = (CircuitOpenError, DeadlineExceeded)
+
+
+def new_request(resource: str):
+    handler = resource_handlers[resource]
+    return getattr(lazy_import(handler.module), handler.request)()
+
+
+def info_metric_name(resource: str):
+    return 'aliyun_meta_' + resource_handlers[resource].info
+
+
+def resource_product(resource: str):
+    if resource_handlers[resource].request is None:
+        return None
+    return new_request(resource).get_product()
 
-from aliyun_exporter.utils import try_or_else
 
 # cache = TTLCache(maxsize=100, ttl=3600) #临时关闭一小时的缓存
 
@@ -35,38 +83,45 @@ Different resource has different information structure, and most of
 them are nested, for simplicity, we map the top-level attributes to the
 labels of metric, and handle nested attribute specially. If a nested
 attribute is not handled explicitly, it will be dropped.
+
+The labels of each resource can be narrowed by 'include' (allowlist) and
+'exclude' (denylist) and renamed by 'rename' in the 'info_labels' config.
 '''
 
 
 class InfoProvider():
 
-    def __init__(self, ak, secret, region_id):
+    def __init__(self, ak, secret, region_id, info_labels=None, series_guard=None, controller=None):
         self.client = None
+        self.labels = {}
         self.ak = ak
         self.secret = secret
         self.region_id = region_id
+        self.info_labels = info_labels if info_labels is not None else {}
+        self.series_guard = series_guard if series_guard is not None else SeriesGuard()
+        self.controller = controller
 
     # @cached(cache) #临时关闭一小时的缓存
-    def get_metrics(self, resource: str, client: AcsClient) -> GaugeMetricFamily:
-        self.client = client
-        return {
-            'ecs': lambda: self.ecs_info(),
-            'rds': lambda: self.rds_info(),
-            'redis': lambda: self.redis_info(),
-            'slb': lambda: self.slb_info(),
-            'mongodb': lambda: self.mongodb_info(),
-            'polardb': lambda: self.polardb_info(),
-            'oss': lambda: self.oss_info(),
-            'dts_migration': lambda: self.dts_migration_info(),
-            'dts_subcription': lambda: self.dts_subscription_info(),
-            'dts_synchroniza': lambda: self.dts_synchroniza_info(),
-            'mq': lambda: self.mq_info(),
-            'elasticsearch': lambda: self.elasticsearch_info(),
-            # 'eip': lambda: self.eip_info(),
-        }[resource]()
+    def get_metrics(self, resource: str, client: AcsClient, labels=None, series_guard=None) -> GaugeMetricFamily:
+        '''
+        'labels' and 'series_guard' override the configured ones for this call.
+        '''
+        # resources are collected concurrently, every call works on its own copy
+        provider = copy(self)
+        provider.client = client
+        provider.labels = labels if labels is not None else self.info_labels.get(resource) or {}
+        if series_guard is not None:
+            provider.series_guard = series_guard
+        return getattr(provider, resource_handlers[resource].info)()
+
+    def do_action(self, req):
+        if self.controller is None:
+            return self.client.do_action_with_exception(req)
+        return self.controller.call(req.get_product(), self.client.get_region_id(),
+                                    lambda: self.client.do_action_with_exception(req))
 
     def ecs_info(self) -> GaugeMetricFamily:
-        req = DescribeECS.DescribeInstancesRequest()
+        req = new_request('ecs')
         nested_handler = {
             'InnerIpAddress': lambda obj: try_or_else(lambda: obj['IpAddress'][0], ''),
             'PublicIpAddress': lambda obj: try_or_else(lambda: obj['IpAddress'][0], ''),
@@ -75,29 +130,30 @@ class InfoProvider():
         return self.info_template(req, 'aliyun_meta_ecs_info', nested_handler=nested_handler)
 
     def rds_info(self) -> GaugeMetricFamily:
-        req = DescribeRDS.DescribeDBInstancesRequest()
+        req = new_request('rds')
         return self.info_template(req, 'aliyun_meta_rds_info', to_list=lambda data: data['Items']['DBInstance'])
 
     def redis_info(self) -> GaugeMetricFamily:
-        req = DescribeRedis.DescribeInstancesRequest()
+        req = new_request('redis')
         return self.info_template(req, 'aliyun_meta_redis_info',
                                   to_list=lambda data: data['Instances']['KVStoreInstance'])
 
     def slb_info(self) -> GaugeMetricFamily:
-        req = DescribeSLB.DescribeLoadBalancersRequest()
+        req = new_request('slb')
         return self.info_template(req, 'aliyun_meta_slb_info',
                                   to_list=lambda data: data['LoadBalancers']['LoadBalancer'])
 
     def mongodb_info(self) -> GaugeMetricFamily:
-        req = Mongodb.DescribeDBInstancesRequest()
+        req = new_request('mongodb')
         return self.info_template(req, 'aliyun_meta_mongodb_info',
                                   to_list=lambda data: data['DBInstances']['DBInstance'])
 
     def polardb_info(self) -> GaugeMetricFamily:
-        req = Polardb.DescribeDBClustersRequest()
+        req = new_request('polardb')
         return self.info_template(req, 'aliyun_meta_polardb_info', to_list=lambda data: data['Items']['DBCluster'])
 
     def oss_info(self) -> GaugeMetricFamily:
+        oss2 = lazy_import('oss2')
         auth = oss2.Auth(self.ak, self.secret)
         service = oss2.Service(auth, 'http://oss-{resion_id}.aliyuncs.com'.format(resion_id=self.region_id))
         nested_handler = None
@@ -148,8 +204,8 @@ class InfoProvider():
                     continue
             if gauge == None:
                 label_keys = self.label_keys(instance_dict, nested_handler)
-                gauge = GaugeMetricFamily('aliyun_meta_oss_info', '', labels=label_keys)
-            gauge.add_metric(labels=self.label_values(instance_dict, label_keys, nested_handler), value=1.0)
+                gauge = GaugeMetricFamily('aliyun_meta_oss_info', '', labels=self.label_names(label_keys))
+            self.series_guard.add_metric(gauge, self.label_values(instance_dict, label_keys, nested_handler), 1.0)
         return gauge
 
     def dts_migration_info(self) -> GaugeMetricFamily:
@@ -157,7 +213,7 @@ class InfoProvider():
         数据迁移
         :return:
         """
-        req = DescribeMigrationJobsRequest.DescribeMigrationJobsRequest()
+        req = new_request('dts_migration')
         return self.new_info_template(req, 'aliyun_meta_dts_migration_info',
                                       to_list=lambda data: data['MigrationJobs']['MigrationJob'])
 
@@ -166,7 +222,7 @@ class InfoProvider():
         数据订阅
         :return:
         """
-        req = DescribeSubscriptionInstancesRequest.DescribeSubscriptionInstancesRequest()
+        req = new_request('dts_subcription')
         return self.new_info_template(req, 'aliyun_meta_dts_subscription_info',
                                       to_list=lambda data: data['SubscriptionInstances']['SubscriptionInstance'])
 
@@ -175,30 +231,30 @@ class InfoProvider():
         数据同步
         :return:
         """
-        req = DescribeSynchronizationJobsRequest.DescribeSynchronizationJobsRequest()
+        req = new_request('dts_synchroniza')
         return self.new_info_template(req, 'aliyun_meta_dts_synchroniza_info',
                                       to_list=lambda data: data['SynchronizationInstances'])
 
     def mq_info(self) -> GaugeMetricFamily:
-        req = OnsInstanceInServiceListRequest.OnsInstanceInServiceListRequest()
-        resp = self.client.do_action_with_exception(req)
-        data = json.loads(resp)
+        req = new_request('mq')
+        resp = self.do_action(req)
         nested_handler = None
         gauge = None
         label_keys = None
-        for i in data['Data']['InstanceVO']:
+        for i in decode_page(resp, lambda data: data['Data']['InstanceVO'],
+                             lambda instance: self.project(instance, nested_handler)):
             if gauge == None:
                 label_keys = self.label_keys(i, nested_handler)
-                gauge = GaugeMetricFamily('aliyun_meta_mq_info', '', labels=label_keys)
-            gauge.add_metric(labels=self.label_values(i, label_keys, nested_handler), value=1.0)
+                gauge = GaugeMetricFamily('aliyun_meta_mq_info', '', labels=self.label_names(label_keys))
+            self.series_guard.add_metric(gauge, self.label_values(i, label_keys, nested_handler), 1.0)
         return gauge
 
     def elasticsearch_info(self) -> GaugeMetricFamily:
-        req = ElasticSearch.ListInstanceRequest()
+        req = new_request('elasticsearch')
         return self.es_info_template(req, 'aliyun_meta_elasticsearch_info', to_list=lambda data: data['Result'])
 
     # def eip_info(self) -> GaugeMetricFamily:
-    #     req = DescribeEipAddressesRequest.DescribeEipAddressesRequest()
+    #     req = new_request('eip')
     #     return self.info_template(req, 'aliyun_meta_eip_info')
 
 
@@ -217,29 +273,29 @@ class InfoProvider():
                       to_list=(lambda data: data['Instances']['Instance'])) -> GaugeMetricFamily:
         gauge = None
         label_keys = None
-        pager_generator_result = self.pager_generator(req, page_size, page_num, to_list)
+        pager_generator_result = self.pager_generator(req, page_size, page_num, to_list,
+                                                      project=lambda instance: self.project(instance, nested_handler))
         if isinstance(pager_generator_result, Iterable):
             for instance in pager_generator_result:
                 if gauge is None:
                     label_keys = self.label_keys(instance, nested_handler)
-                    gauge = GaugeMetricFamily(name, desc, labels=label_keys)
-                gauge.add_metric(labels=self.label_values(instance, label_keys, nested_handler), value=1.0)
+                    gauge = GaugeMetricFamily(name, desc, labels=self.label_names(label_keys))
+                self.series_guard.add_metric(gauge, self.label_values(instance, label_keys, nested_handler), 1.0)
         return gauge
 
-    def pager_generator(self, req, page_size, page_num, to_list):
+    def pager_generator(self, req, page_size, page_num, to_list, project=None):
         req.set_PageSize(page_size)
         while True:
             req.set_PageNumber(page_num)
             try:
-                resp = self.client.do_action_with_exception(req)
+                resp = self.do_action(req)
+            except not_retried:
+                raise
             except Exception as e:
                 print(e)
-                try:
-                    resp = self.client.do_action_with_exception(req)
-                except Exception as e:
-                    break
-            data = json.loads(resp)
-            instances = to_list(data)
+                # a listing cut short must not pass for the whole inventory
+                resp = self.do_action(req)
+            instances = decode_page(resp, to_list, project)
             for instance in instances:
                 yield instance
             if len(instances) < page_size:
@@ -267,38 +323,38 @@ class InfoProvider():
         """
         gauge = None
         label_keys = None
-        pager_generator_result = self.new_pager_generator(req, page_size, page_num, to_list)
+        pager_generator_result = self.new_pager_generator(req, page_size, page_num, to_list,
+                                                          project=lambda instance: self.project(instance, nested_handler))
         if isinstance(pager_generator_result, Iterable):
             for instance in pager_generator_result:
                 if gauge is None:
                     label_keys = self.label_keys(instance, nested_handler)
-                    gauge = GaugeMetricFamily(name, desc, labels=label_keys)
-                gauge.add_metric(labels=self.label_values(instance, label_keys, nested_handler), value=1.0)
+                    gauge = GaugeMetricFamily(name, desc, labels=self.label_names(label_keys))
+                self.series_guard.add_metric(gauge, self.label_values(instance, label_keys, nested_handler), 1.0)
         return gauge
 
-    def new_pager_generator(self, req, page_size, page_num, to_list):
+    def new_pager_generator(self, req, page_size, page_num, to_list, project=None):
         """
         为了适配新版本sdk
         :param req:
         :param page_size:
         :param page_num:
         :param to_list:
+        :param project:
         :return:
         """
         req.set_PageSize(page_size)
         while True:
             req.set_PageNum(page_num)
             try:
-                resp = self.client.do_action_with_exception(req)
+                resp = self.do_action(req)
+            except not_retried:
+                raise
             except Exception as e:
                 print(e)
-                try:
-                    resp = self.client.do_action_with_exception(req)
-                except Exception as e:
-                    print("在请求对象{req}的时候，出现异常{e},已经进行跳过处理".format(req=req, e=e))
-                    break
-            data = json.loads(resp)
-            instances = to_list(data)
+                # a listing cut short must not pass for the whole inventory
+                resp = self.do_action(req)
+            instances = decode_page(resp, to_list, project)
             for instance in instances:
                 yield instance
             if len(instances) < page_size:
@@ -326,38 +382,38 @@ class InfoProvider():
         """
         gauge = None
         label_keys = None
-        pager_generator_result = self.es_pager_generator(req, page_size, page_num, to_list)
+        pager_generator_result = self.es_pager_generator(req, page_size, page_num, to_list,
+                                                         project=lambda instance: self.project(instance, nested_handler))
         if isinstance(pager_generator_result, Iterable):
             for instance in pager_generator_result:
                 if gauge is None:
                     label_keys = self.label_keys(instance, nested_handler)
-                    gauge = GaugeMetricFamily(name, desc, labels=label_keys)
-                gauge.add_metric(labels=self.label_values(instance, label_keys, nested_handler), value=1.0)
+                    gauge = GaugeMetricFamily(name, desc, labels=self.label_names(label_keys))
+                self.series_guard.add_metric(gauge, self.label_values(instance, label_keys, nested_handler), 1.0)
         return gauge
 
-    def es_pager_generator(self, req, page_size, page_num, to_list):
+    def es_pager_generator(self, req, page_size, page_num, to_list, project=None):
         """
         为了适配新版本sdk
         :param req:
         :param page_size:
         :param page_num:
         :param to_list:
+        :param project:
         :return:
         """
         req.set_size(page_size)
         while True:
             req.set_page(page_num)
             try:
-                resp = self.client.do_action_with_exception(req)
+                resp = self.do_action(req)
+            except not_retried:
+                raise
             except Exception as e:
                 print(e)
-                try:
-                    resp = self.client.do_action_with_exception(req)
-                except Exception as e:
-                    print("在请求对象{req}的时候，出现异常{e},已经进行跳过处理".format(req=req, e=e))
-                    break
-            data = json.loads(resp)
-            instances = to_list(data)
+                # a listing cut short must not pass for the whole inventory
+                resp = self.do_action(req)
+            instances = decode_page(resp, to_list, project)
             for instance in instances:
                 yield instance
             if len(instances) < page_size:
@@ -368,8 +424,18 @@ class InfoProvider():
     def label_keys(self, instance, nested_handler=None):
         if nested_handler is None:
             nested_handler = {}
+        include = self.labels.get('include')
+        exclude = self.labels.get('exclude') or []
         return [k for k, v in instance.items()
-                if k in nested_handler or isinstance(v, str) or isinstance(v, int)]
+                if (k in nested_handler or isinstance(v, str) or isinstance(v, int))
+                and (include is None or k in include) and k not in exclude]
+
+    def project(self, instance, nested_handler=None):
+        return {k: instance[k] for k in self.label_keys(instance, nested_handler)}
+
+    def label_names(self, label_keys):
+        rename = self.labels.get('rename') or {}
+        return [rename.get(k, k) for k in label_keys]
 
     def label_values(self, instance, label_keys, nested_handler=None):
         if nested_handler is None:
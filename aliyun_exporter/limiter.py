@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+
+from aliyunsdkcore.acs_exception.exceptions import ClientException, ServerException
+from prometheus_client.core import GaugeMetricFamily
+
+from aliyun_exporter.scheduler import DeadlineExceeded, time_left
+
+'''
+Adaptive concurrency and circuit breaking of API endpoints.
+
+Every (product, region) endpoint gets its own concurrency limit, which
+grows by one per window of healthy calls (no error, latency within
+'latency_factor' of the best latency seen) and is halved on throttling,
+timeouts and server errors (AIMD). Other client errors, such as invalid
+parameters, count neither as healthy nor as failed calls.
+
+Endpoints failing 'failure_threshold' times in a row are short-circuited
+for 'cool_down' seconds: calls raise CircuitOpenError without reaching the
+API, so that callers can serve the last known data instead. After the
+cool-down a single trial call decides whether the circuit closes again.
+'''
+
+throttled = 'throttled'
+unavailable = 'unavailable'
+# the endpoint answered, but rejected the request (e.g. invalid parameters)
+neutral = 'neutral'
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, product, region):
+        super().__init__('Circuit of {} in {} is open'.format(product, region))
+        self.product = product
+        self.region = region
+
+
+def classify(e: Exception):
+    if isinstance(e, ServerException):
+        if e.get_error_code() is not None and e.get_error_code().startswith('Throttling'):
+            return throttled
+        if e.get_http_status() is not None and e.get_http_status() >= 500:
+            return unavailable
+        return None
+    if isinstance(e, ClientException):
+        if e.get_error_code() in ('SDK.HttpError', 'SDK.ServerUnreachable'):
+            return unavailable
+        return None
+    return unavailable
+
+
+class Endpoint(object):
+
+    def __init__(self, product, region, initial_concurrency, max_concurrency, latency_factor,
+                 failure_threshold, cool_down):
+        self.product = product
+        self.region = region
+        self.max_concurrency = max_concurrency
+        self.latency_factor = latency_factor
+        self.failure_threshold = failure_threshold
+        self.cool_down = cool_down
+        self.condition = threading.Condition()
+        self.limit = float(min(initial_concurrency, max_concurrency))
+        self.inflight = 0
+        self.healthy = 0
+        self.best_latency = None
+        self.last_decrease = 0
+        self.failures = 0
+        self.open_until = 0
+        self.trial = False
+
+    def is_open(self) -> bool:
+        return time.time() < self.open_until
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                if self.is_open() or self.trial:
+                    raise CircuitOpenError(self.product, self.region)
+                if self.inflight < int(self.limit):
+                    break
+                # do not wait for a slot beyond the deadline of the collection
+                left = time_left()
+                if left is not None and left <= 0:
+                    raise DeadlineExceeded('Scrape budget exhausted waiting for {} in {}'.format(
+                        self.product, self.region))
+                self.condition.wait(left)
+            if self.open_until > 0:
+                # cool-down is over, let a single trial call through
+                self.trial = True
+            self.inflight += 1
+
+    def release(self, latency, error=None):
+        with self.condition:
+            self.inflight -= 1
+            if error is None:
+                self.on_success(latency)
+            elif error == neutral:
+                # tells nothing about the health of the endpoint, a trial is retried by the next call
+                self.trial = False
+            else:
+                self.on_failure(error)
+            self.condition.notify_all()
+
+    def on_success(self, latency):
+        self.failures = 0
+        self.open_until = 0
+        self.trial = False
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        # latencies below 100ms are never considered congested
+        if latency > max(self.best_latency * self.latency_factor, 0.1):
+            self.healthy = 0
+            return
+        self.healthy += 1
+        if self.healthy >= int(self.limit):
+            self.healthy = 0
+            self.limit = min(self.limit + 1, self.max_concurrency)
+
+    def on_failure(self, error):
+        self.healthy = 0
+        self.failures += 1
+        now = time.time()
+        # calls in flight fail together, back off once per latency window
+        if now - self.last_decrease > (self.best_latency or 1):
+            self.last_decrease = now
+            self.limit = max(self.limit / 2, 1)
+        if self.trial or self.failures >= self.failure_threshold:
+            if not self.is_open():
+                logging.warning('Too many failures ({}) of {} in {}, open circuit for {}s'.format(
+                    error, self.product, self.region, self.cool_down))
+            self.open_until = now + self.cool_down
+            self.trial = False
+
+
+class AdaptiveController(object):
+
+    def __init__(self,
+                 initial_concurrency=2,
+                 max_concurrency=10,
+                 latency_factor=2,
+                 failure_threshold=5,
+                 cool_down=60):
+        self.options = dict(initial_concurrency=initial_concurrency, max_concurrency=max_concurrency,
+                            latency_factor=latency_factor, failure_threshold=failure_threshold,
+                            cool_down=cool_down)
+        self.lock = threading.Lock()
+        self.endpoints = dict()
+
+    def endpoint(self, product: str, region: str) -> Endpoint:
+        key = (product, region)
+        endpoint = self.endpoints.get(key)
+        if endpoint is None:
+            with self.lock:
+                endpoint = self.endpoints.setdefault(key, Endpoint(product, region, **self.options))
+        return endpoint
+
+    def is_open(self, product: str, region: str) -> bool:
+        return self.endpoint(product, region).is_open()
+
+    def call(self, product: str, region: str, op):
+        endpoint = self.endpoint(product, region)
+        endpoint.acquire()
+        start_time = time.time()
+        try:
+            result = op()
+        except Exception as e:
+            endpoint.release(time.time() - start_time, classify(e) or neutral)
+            raise
+        endpoint.release(time.time() - start_time)
+        return result
+
+    def gauges(self):
+        limit = GaugeMetricFamily('aliyun_exporter_concurrency_limit',
+                                  'Adaptive concurrency limit of an API endpoint.', labels=['product', 'region'])
+        circuit = GaugeMetricFamily('aliyun_exporter_circuit_open',
+                                    'Whether the circuit of an API endpoint is open.', labels=['product', 'region'])
+        for (product, region), endpoint in sorted(self.endpoints.items(), key=lambda item: str(item[0])):
+            limit.add_metric([product, str(region)], int(endpoint.limit))
+            circuit.add_metric([product, str(region)], int(endpoint.is_open()))
+        return [limit, circuit]
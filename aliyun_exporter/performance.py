@@ -0,0 +1,211 @@
+import calendar
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import partial
+
+from prometheus_client.core import GaugeMetricFamily
+
+from aliyun_exporter.decoder import decode, loads
+from aliyun_exporter.limiter import CircuitOpenError
+from aliyun_exporter.scheduler import DeadlineExceeded
+from aliyun_exporter.utils import lazy_import
+
+'''
+Per-instance performance collectors of the special projects.
+
+These metrics are not in CloudMonitor, they come from the API of every
+product, one instance per call. A PerformanceCollector takes the instance
+IDs from the inventory of its resource (cached by the account collector)
+in one task per region, which splits them into batches of 'batch_size'
+instances and returns one follow-up task per batch, so that listing runs
+within the scrape budget and the batches run in parallel on the
+scheduler. Every call goes through the adaptive controller of the
+account.
+
+All the instances of a collection are queried for the same window of
+'window' minutes, aligned to the minute, and the latest value of every
+performance key is emitted in a single family with one sample per instance.
+'''
+
+
+class PerformanceCollector(ABC):
+    # info resource listing the instances and the ID field of an instance
+    resource = None
+    id_key = None
+    module = None
+    request = None
+    time_format = '%Y-%m-%dT%H:%MZ'
+
+    def __init__(self, parent, project, batch_size=10, window=5):
+        self.parent = parent
+        self.project = project
+        self.batch_size = batch_size
+        self.window = window
+        self.keys = [metric['name'] for metric in parent.metrics[project]]
+
+    @classmethod
+    def product(cls):
+        return getattr(lazy_import(cls.module), cls.request)().get_product()
+
+    def tasks(self):
+        end = int(time.time()) // 60 * 60
+        start = end - self.window * 60
+        return [partial(self.batches, region, start, end) for region in self.parent.info_regions()]
+
+    def batches(self, region, start, end):
+        ids = self.parent.instance_ids(self.resource, self.id_key, region)
+        for i in range(0, len(ids), self.batch_size):
+            yield partial(self.collect_batch, region, ids[i:i + self.batch_size], start, end)
+
+    def collect_batch(self, region, ids, start, end):
+        families = OrderedDict()
+        for instance_id in ids:
+            try:
+                data = self.query(region, instance_id, start, end)
+                # parsed in full first, a malformed response only loses its own instance
+                series = [(name, labels, float(value), timestamp)
+                          for name, labels, value, timestamp in self.parse(instance_id, data)]
+            except (CircuitOpenError, DeadlineExceeded) as e:
+                logging.warning('{}, skip {} instances of {}'.format(e, len(ids), self.project))
+                break
+            except Exception as e:
+                logging.error('Error query {} of {}'.format(self.project, instance_id), exc_info=e)
+                continue
+            for name, labels, value, timestamp in series:
+                gauge = families.get(name)
+                if gauge is None:
+                    gauge = families[name] = GaugeMetricFamily(self.parent.format_metric_name(self.project, name),
+                                                               '', labels=list(labels))
+                self.parent.series_guard.add_metric(gauge, list(labels.values()), value,
+                                                    self.parent.timestamp(timestamp))
+        return list(families.values())
+
+    def query(self, region, instance_id, start, end):
+        req = getattr(lazy_import(self.module), self.request)()
+        self.prepare(req, instance_id, format_time(start, self.time_format), format_time(end, self.time_format))
+        client = self.parent.get_client(region)
+        resp = self.parent.controller.call(req.get_product(), region, lambda: client.do_action_with_exception(req))
+        return decode(resp)
+
+    @abstractmethod
+    def prepare(self, req, instance_id, start, end):
+        '''
+        Set the instance, the performance keys and the window on a request.
+        '''
+
+    @abstractmethod
+    def parse(self, instance_id, data):
+        '''
+        Yield (name, labels, value, timestamp in milliseconds) of the latest
+        value of every performance key in a response.
+        '''
+
+
+class RDSPerformanceCollector(PerformanceCollector):
+    resource = 'rds'
+    id_key = 'DBInstanceId'
+    module = 'aliyunsdkrds.request.v20140815.DescribeDBInstancePerformanceRequest'
+    request = 'DescribeDBInstancePerformanceRequest'
+    values_field = 'Values'
+
+    def prepare(self, req, instance_id, start, end):
+        req.set_DBInstanceId(instance_id)
+        req.set_Key(','.join(self.keys))
+        req.set_StartTime(start)
+        req.set_EndTime(end)
+
+    def parse(self, instance_id, data):
+        for key in data['PerformanceKeys']['PerformanceKey']:
+            values = key[self.values_field]['PerformanceValue']
+            if len(values) < 1:
+                continue
+            value_format = key.get('ValueFormat')
+            names = value_format.split('&') if value_format is not None and '&' in value_format else ['value']
+            latest = values[-1]
+            timestamp = parse_time(latest['Date'])
+            for name, v in zip(names, latest['Value'].split('&')):
+                yield '{}_{}'.format(key['Key'], name), {'instanceId': instance_id}, v, timestamp
+
+
+class MongoDBPerformanceCollector(RDSPerformanceCollector):
+    resource = 'mongodb'
+    id_key = 'DBInstanceId'
+    module = 'aliyunsdkdds.request.v20151201.DescribeDBInstancePerformanceRequest'
+    request = 'DescribeDBInstancePerformanceRequest'
+    values_field = 'PerformanceValues'
+
+
+class RedisPerformanceCollector(PerformanceCollector):
+    resource = 'redis'
+    id_key = 'InstanceId'
+    module = 'aliyunsdkr_kvstore.request.v20150101.DescribeHistoryMonitorValuesRequest'
+    request = 'DescribeHistoryMonitorValuesRequest'
+    time_format = '%Y-%m-%dT%H:%M:%SZ'
+
+    def prepare(self, req, instance_id, start, end):
+        req.set_InstanceId(instance_id)
+        req.set_MonitorKeys(','.join(self.keys))
+        req.set_IntervalForHistory('01m')
+        req.set_StartTime(start)
+        req.set_EndTime(end)
+
+    def parse(self, instance_id, data):
+        # MonitorHistory is a JSON string of {time: {key: value}}
+        history = data.get('MonitorHistory')
+        if not history:
+            return
+        if isinstance(history, str):
+            history = loads(history)
+        if len(history) < 1:
+            return
+        date = max(history)
+        timestamp = parse_time(date)
+        for key, value in history[date].items():
+            if key in self.keys:
+                yield key, {'instanceId': instance_id}, value, timestamp
+
+
+class PolarDBPerformanceCollector(PerformanceCollector):
+    resource = 'polardb'
+    id_key = 'DBClusterId'
+    module = 'aliyunsdkpolardb.request.v20170801.DescribeDBClusterPerformanceRequest'
+    request = 'DescribeDBClusterPerformanceRequest'
+
+    def prepare(self, req, instance_id, start, end):
+        req.set_DBClusterId(instance_id)
+        req.set_Key(','.join(self.keys))
+        req.set_StartTime(start)
+        req.set_EndTime(end)
+
+    def parse(self, instance_id, data):
+        for item in data['PerformanceKeys']['PerformanceItem']:
+            points = item['Points']['PerformanceItemValue']
+            if len(points) < 1:
+                continue
+            latest = points[-1]
+            labels = OrderedDict([('clusterId', instance_id), ('nodeId', item.get('DBNodeId', ''))])
+            yield '{}_{}'.format(item['Measurement'], item['MetricName']), labels, latest['Value'], \
+                int(latest.get('Timestamp', 0))
+
+
+special_projects = {
+    'rds_performance': RDSPerformanceCollector,
+    'redis_performance': RedisPerformanceCollector,
+    'mongodb_performance': MongoDBPerformanceCollector,
+    'polardb_performance': PolarDBPerformanceCollector,
+}
+
+
+def format_time(timestamp, time_format):
+    return time.strftime(time_format, time.gmtime(timestamp))
+
+
+def parse_time(value):
+    for time_format in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%MZ'):
+        try:
+            return calendar.timegm(time.strptime(value, time_format)) * 1000
+        except ValueError:
+            pass
+    return 0
@@ -0,0 +1,268 @@
+import math
+from collections import namedtuple
+
+from aliyun_exporter.collector import CollectorConfig, group_metrics, info_regions
+from aliyun_exporter.info_provider import resource_product
+from aliyun_exporter.performance import special_projects
+from aliyun_exporter.utils import SeriesGuard
+
+'''
+Cost planner of a configuration.
+
+For every account, the planner estimates the API calls of one collection
+per API product, the time 'rate_limit' needs for its CloudMonitor calls
+and the expected series. All the accounts share the worker pool of the
+top-level 'pool_size', the expected duration of a collection is estimated
+once from the calls of every account and an assumed call latency.
+
+Series and instance counts come from what a running collector has cached
+(datapoints, info metrics and inventory), or from listing the inventory
+when 'fetch_inventory' is set. Metrics which were not collected yet are
+estimated from the inventory of their resource, which is a lower bound
+for metrics with more dimensions than the instance. Unknown counts are
+None.
+
+Entries exceeding 'max_series', collections exceeding the scrape timeout
+or the interval, products exceeding their monthly quota and failed
+inventory listings are flagged.
+'''
+
+# free monthly invocations of the API products
+default_quotas = {'Cms': 5000000}
+# page size of the Describe calls of the inventory
+page_size = 100
+# resource of the instances of a CloudMonitor project
+project_resources = {
+    'acs_ecs_dashboard': 'ecs',
+    'acs_rds_dashboard': 'rds',
+    'acs_kvstore': 'redis',
+    'acs_slb_dashboard': 'slb',
+    'acs_mongodb': 'mongodb',
+    'acs_polardb': 'polardb',
+}
+
+PlanEntry = namedtuple('PlanEntry', ['kind', 'product', 'name', 'calls', 'series', 'warnings'])
+AccountPlan = namedtuple('AccountPlan', ['account', 'entries', 'calls', 'duration', 'series', 'warnings'])
+TotalPlan = namedtuple('TotalPlan', ['calls', 'duration', 'warnings'])
+
+
+class Planner(object):
+
+    def __init__(self, config: CollectorConfig, collector=None, interval=60, latency=0.5, quotas=None,
+                 fetch_inventory=False):
+        if interval <= 0:
+            raise ValueError('interval must be positive, got {}'.format(interval))
+        if latency < 0:
+            raise ValueError('latency must not be negative, got {}'.format(latency))
+        self.config = config
+        self.collector = collector
+        self.interval = interval
+        self.latency = latency
+        self.quotas = dict(default_quotas)
+        self.quotas.update(quotas or {})
+        self.fetch_inventory = fetch_inventory
+        self.listed = dict()
+        self.failed = dict()
+
+    def plan(self):
+        configs = self.config.accounts if self.config.accounts is not None else [self.config]
+        return [self.account_plan(c) for c in configs]
+
+    def total(self, plans) -> TotalPlan:
+        '''
+        Duration of a collection of every account on the shared worker pool,
+        bounded by the slowest account under its 'rate_limit'.
+        '''
+        calls = sum(sum(plan.calls.values()) for plan in plans)
+        duration = max([calls * self.latency / self.config.pool_size] + [plan.duration for plan in plans])
+        return TotalPlan(calls, duration, self.duration_warnings(duration))
+
+    def duration_warnings(self, duration, what='expected duration'):
+        warnings = []
+        timeout = self.config.scrape_timeout if self.config.push is None else None
+        if timeout is not None and duration > timeout:
+            warnings.append('{} {:.1f}s exceeds scrape_timeout {}s'.format(what, duration, timeout))
+        if duration > self.interval:
+            warnings.append('{} {:.1f}s exceeds the interval {}s'.format(what, duration, self.interval))
+        return warnings
+
+    def account_plan(self, config: CollectorConfig) -> AccountPlan:
+        account = None
+        if self.collector is not None:
+            account = self.collector.accounts.get(config.name)
+        regions = info_regions(config)
+        entries = []
+        metrics = config.metrics or {}
+        for project, items in metrics.items():
+            if project in special_projects:
+                entries.extend(self.special_entries(config, account, project, regions))
+                continue
+            for specs in group_metrics(items):
+                entries.append(self.metric_entry(config, account, project, specs, regions))
+        for resource in config.info_metrics or []:
+            for region in regions:
+                instances = self.instances(account, resource, region)
+                entries.append(self.entry(config, 'info', resource_product(resource) or resource,
+                                          '{} ({})'.format(resource, region), pages(instances), instances,
+                                          self.listing_warnings(account, resource, [region])))
+
+        calls = dict()
+        for entry in entries:
+            calls[entry.product] = calls.get(entry.product, 0) + entry.calls
+        # the worker pool is shared by the accounts, see 'total', the rate limit is not
+        duration = calls.get('Cms', 0) / config.rate_limit
+        known = [e.series for e in entries if e.series is not None]
+        series = sum(known) if len(known) > 0 else None
+
+        warnings = self.duration_warnings(duration, 'rate limited duration')
+        for product, count in sorted(calls.items()):
+            quota = self.quotas.get(product)
+            monthly = count * monthly_collections(self.interval)
+            if quota is not None and monthly > quota:
+                warnings.append('{} calls of {} per month exceed the quota {}'.format(int(monthly), product, quota))
+        return AccountPlan(config.name, entries, calls, duration, series, warnings)
+
+    def project_cost(self, project, metrics):
+        '''
+        Cost of collecting 'metrics' metrics of a project with the first
+        account, as in the YAML generated from the metrics meta.
+        '''
+        config = self.config.accounts[0] if self.config.accounts else self.config
+        account = self.collector.accounts.get(config.name) if self.collector is not None else None
+        regions = info_regions(config)
+        instances = self.resource_instances(account, project_resources.get(project), regions)
+        return dict(calls=metrics, monthly=int(metrics * monthly_collections(self.interval)),
+                    duration=metrics / config.rate_limit, series=None if instances is None else instances * metrics)
+
+    def entry(self, config, kind, product, name, calls, series, warnings=None, family_series=None):
+        # max_series applies to every family, an entry may emit several
+        family_series = family_series if family_series is not None else series
+        warnings = list(warnings or [])
+        if family_series is not None and config.max_series is not None and family_series > config.max_series:
+            warnings.append('{} series per family exceed max_series {}'.format(family_series, config.max_series))
+        return PlanEntry(kind, product, name, calls, series, warnings)
+
+    def metric_entry(self, config, account, project, specs, regions):
+        metric_name, period = specs[0].metric_name, specs[0].period
+        columns = account.point_cache.get(project, metric_name, period) if account is not None else None
+        warnings = []
+        if columns is not None:
+            # the columns may be updated by a running collection
+            with account.point_cache.lock(project, metric_name, period):
+                rows = len(columns)
+                groups = [[sum(len(list(columns.aggregate(m, rule.by, ['count']))) for m in spec.measures)
+                           for rule in spec.aggregate] for spec in specs]
+        else:
+            rows = self.resource_instances(account, project_resources.get(project), regions)
+            if rows is not None and project in project_resources:
+                warnings.append('estimated from the {} inventory'.format(project_resources[project]))
+            warnings.extend(self.listing_warnings(account, project_resources.get(project), regions))
+            groups = [[len(spec.measures) * (1 if len(rule.by) < 1 else rows or 0) for rule in spec.aggregate]
+                      for spec in specs]
+        series = None
+        if rows is not None:
+            series = 0
+            for spec, spec_groups in zip(specs, groups):
+                if not spec.drop_raw:
+                    series += rows * len(spec.measures)
+                for rule, count in zip(spec.aggregate, spec_groups):
+                    series += count * len(rule.ops)
+        return self.entry(config, 'metric', 'Cms', '{}/{} ({}s)'.format(project, metric_name, period), 1, series,
+                          warnings, rows)
+
+    def special_entries(self, config, account, project, regions):
+        collector = special_projects[project]
+        keys = len(config.metrics[project])
+        for region in regions:
+            instances = self.instances(account, collector.resource, region)
+            # inventory listings are amortized over 'inventory_ttl'
+            listing = pages(instances) * min(1.0, self.interval / config.inventory_ttl)
+            calls = (instances or 0) + listing
+            series = instances * keys if instances is not None else None
+            warnings = [] if instances is not None else ['instance count unknown']
+            warnings.extend(self.listing_warnings(account, collector.resource, [region]))
+            yield self.entry(config, 'special', collector.product(), '{} ({})'.format(project, region),
+                             calls, series, warnings, instances)
+
+    def resource_instances(self, account, resource, regions):
+        if resource is None:
+            return None
+        counts = [self.instances(account, resource, region) for region in regions]
+        if any(c is None for c in counts):
+            return None
+        return sum(counts)
+
+    def instances(self, account, resource, region):
+        if account is None:
+            return None
+        gauge = account.info_cache.get((resource, region))
+        if gauge is not None:
+            return len(gauge.samples)
+        entry = account.inventory.get((resource, region))
+        if entry is not None:
+            return len(entry[1])
+        if not self.fetch_inventory:
+            return None
+        key = (account.config.name, resource, region)
+        if key not in self.listed:
+            # list the instances without labels, the count is all that is needed
+            try:
+                gauge = account.info_provider.get_metrics(resource, account.get_client(region),
+                                                          labels={'include': []}, series_guard=SeriesGuard())
+                self.listed[key] = 0 if gauge is None else len(gauge.samples)
+            except Exception as e:
+                self.listed[key] = None
+                self.failed[key] = e
+        return self.listed[key]
+
+    def listing_warnings(self, account, resource, regions):
+        if account is None:
+            return []
+        warnings = []
+        for region in regions:
+            error = self.failed.get((account.config.name, resource, region))
+            if error is not None:
+                warnings.append('listing {} in {} failed: {}'.format(resource, region, error))
+        return warnings
+
+
+def pages(instances):
+    if instances is None:
+        return 1
+    return max(1, int(math.ceil(instances / page_size)))
+
+
+def monthly_collections(interval):
+    return 30 * 24 * 3600 / interval
+
+
+def format_plan(plans, interval=60, total: TotalPlan = None) -> str:
+    lines = []
+    for plan in plans:
+        lines.append('Account: {}'.format(plan.account or 'default'))
+        lines.append('  {:<8} {:<12} {:<56} {:>8} {:>10}'.format('kind', 'product', 'entry', 'calls', 'series'))
+        for entry in plan.entries:
+            lines.append('  {:<8} {:<12} {:<56} {:>8} {:>10}{}'.format(
+                entry.kind, entry.product, entry.name, format_count(entry.calls), format_count(entry.series),
+                ''.join('  ! {}'.format(w) for w in entry.warnings)))
+        for product, calls in sorted(plan.calls.items()):
+            lines.append('  {} calls per {}s interval: {}, per month: {}'.format(
+                product, interval, format_count(calls), int(calls * monthly_collections(interval))))
+        lines.append('  rate limited duration: {:.1f}s, expected series: {}'.format(
+            plan.duration, format_count(plan.series)))
+        for warning in plan.warnings:
+            lines.append('  ! {}'.format(warning))
+    if total is not None:
+        lines.append('All accounts: {} calls per {}s interval, expected duration: {:.1f}s'.format(
+            format_count(total.calls), interval, total.duration))
+        for warning in total.warnings:
+            lines.append('  ! {}'.format(warning))
+    return '\n'.join(lines)
+
+
+def format_count(count):
+    if count is None:
+        return '?'
+    if isinstance(count, float) and not count.is_integer():
+        return '{:.2f}'.format(count)
+    return str(int(count))
@@ -0,0 +1,234 @@
+import logging
+import queue
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from prometheus_client import Counter
+
+'''
+Push mode: instead of waiting to be scraped, a background loop collects
+every 'interval' seconds and pushes the samples, with their CloudMonitor
+timestamps, to a Prometheus remote-write endpoint.
+
+Samples are sharded by series into bounded queues, samples arriving at
+a full queue are dropped. Every shard has a sender thread which batches
+up to 'batch_size' samples (or whatever arrived in 'batch_deadline'
+seconds), encodes them as a snappy-compressed protobuf WriteRequest and
+retries failed requests with exponential backoff.
+
+python-snappy is used when installed, otherwise a pure-Python snappy
+compressor.
+'''
+
+samplesCounter = Counter('aliyun_exporter_remote_write_samples', 'Samples handled by the remote-write sender',
+                         ['result'])
+
+
+def snappy_compress(data: bytes) -> bytes:
+    '''
+    Compress data in the snappy block format: greedy matching of 4-byte
+    sequences, emitting literals and copies with 2-byte offsets.
+    '''
+    out = bytearray(varint(len(data)))
+    table = dict()
+    literal = 0
+    i = 0
+    end = len(data) - 4
+    while i <= end:
+        key = data[i:i + 4]
+        candidate = table.get(key)
+        table[key] = i
+        if candidate is None or i - candidate > 0xffff:
+            i += 1
+            continue
+        length = 4
+        while i + length < len(data) and data[candidate + length] == data[i + length]:
+            length += 1
+        emit_literal(out, data[literal:i])
+        offset = i - candidate
+        i += length
+        literal = i
+        while length > 0:
+            chunk = min(length, 64)
+            out.append(((chunk - 1) << 2) | 2)
+            out += struct.pack('<H', offset)
+            length -= chunk
+    emit_literal(out, data[literal:])
+    return bytes(out)
+
+
+def emit_literal(out: bytearray, literal: bytes):
+    if len(literal) == 0:
+        return
+    n = len(literal) - 1
+    if n < 60:
+        out.append(n << 2)
+    else:
+        size = (n.bit_length() + 7) // 8
+        out.append((59 + size) << 2)
+        out += n.to_bytes(size, 'little')
+    out += literal
+
+
+def varint(n: int) -> bytes:
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+try:
+    import snappy
+
+    compress = snappy.compress
+except ImportError:
+    compress = snappy_compress
+
+
+'''
+Protobuf encoding of the remote-write messages:
+
+  WriteRequest { repeated TimeSeries timeseries = 1; }
+  TimeSeries   { repeated Label labels = 1; repeated Sample samples = 2; }
+  Label        { string name = 1; string value = 2; }
+  Sample       { double value = 1; int64 timestamp = 2; }
+'''
+
+
+def field(number: int, payload: bytes) -> bytes:
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def encode_series(labels, value: float, timestamp_ms: int) -> bytes:
+    out = bytearray()
+    for name, label_value in labels:
+        out += field(1, field(1, name.encode('utf-8')) + field(2, label_value.encode('utf-8')))
+    sample = b'\x09' + struct.pack('<d', value) + b'\x10' + varint(timestamp_ms & 0xffffffffffffffff)
+    out += field(2, sample)
+    return bytes(out)
+
+
+def encode_write_request(series) -> bytes:
+    return b''.join(field(1, s) for s in series)
+
+
+class RemoteWriter(object):
+
+    def __init__(self,
+                 url,
+                 shards=4,
+                 queue_size=100000,
+                 batch_size=1000,
+                 batch_deadline=5,
+                 max_retries=5,
+                 timeout=10,
+                 headers=None,
+                 ):
+        if url is None:
+            raise Exception('url must be set in push config.')
+        self.url = url
+        self.batch_size = batch_size
+        self.batch_deadline = batch_deadline
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.headers = {
+            'Content-Encoding': 'snappy',
+            'Content-Type': 'application/x-protobuf',
+            'User-Agent': 'aliyun-exporter',
+            'X-Prometheus-Remote-Write-Version': '0.1.0',
+        }
+        self.headers.update(headers or {})
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self.send_loop, args=(q,), daemon=True,
+                                         name='remote-write-{}'.format(i)) for i, q in enumerate(self.queues)]
+        for t in self.threads:
+            t.start()
+
+    def write(self, families, default_timestamp=None):
+        default_timestamp = default_timestamp if default_timestamp is not None else time.time()
+        for family in families:
+            for s in family.samples:
+                labels = sorted(dict(s.labels, __name__=s.name).items())
+                timestamp = s.timestamp if s.timestamp is not None else default_timestamp
+                series = (tuple(labels), float(s.value), int(float(timestamp) * 1000))
+                try:
+                    self.queues[hash(series[0]) % len(self.queues)].put_nowait(series)
+                except queue.Full:
+                    samplesCounter.labels('dropped').inc()
+
+    def send_loop(self, q: queue.Queue):
+        # queued samples are still sent after stop
+        while not self.stopped.is_set() or not q.empty():
+            try:
+                batch = [q.get(timeout=self.batch_deadline)]
+            except queue.Empty:
+                continue
+            deadline = time.time() + self.batch_deadline
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                try:
+                    batch.append(q.get(timeout=remaining) if remaining > 0 else q.get_nowait())
+                except queue.Empty:
+                    break
+            self.send(batch)
+
+    def send(self, batch) -> bool:
+        body = compress(encode_write_request(encode_series(*series) for series in batch))
+        backoff = 0.1
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 5)
+            req = urllib.request.Request(self.url, data=body, headers=self.headers, method='POST')
+            try:
+                with urllib.request.urlopen(req, timeout=self.timeout):
+                    pass
+                samplesCounter.labels('sent').inc(len(batch))
+                return True
+            except urllib.error.HTTPError as e:
+                # a rejected batch will be rejected again, only retry on server errors
+                if e.code < 500 and e.code != 429:
+                    logging.error('Remote write rejected {} samples: {}'.format(len(batch), e))
+                    break
+                logging.warning('Error remote write, attempt {}: {}'.format(attempt + 1, e))
+            except Exception as e:
+                logging.warning('Error remote write, attempt {}: {}'.format(attempt + 1, e))
+        samplesCounter.labels('failed').inc(len(batch))
+        return False
+
+    def stop(self):
+        self.stopped.set()
+        for t in self.threads:
+            t.join()
+
+
+class PushLoop(object):
+
+    def __init__(self, collector, writer: RemoteWriter, interval=60):
+        self.collector = collector
+        self.writer = writer
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True, name='push-loop')
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            start_time = time.time()
+            try:
+                self.writer.write(self.collector.collect(), start_time)
+            except Exception as e:
+                logging.error('Error collecting metrics to push', exc_info=e)
+            self.stopped.wait(max(0, self.interval - (time.time() - start_time)))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+FairScheduler runs the collection tasks of one or more accounts on a shared
+pool of worker threads.
+
+Tasks are dispatched round-robin across the accounts, and an account may
+only occupy its share of the workers while other accounts have queued
+tasks, so that an account with thousands of tasks cannot starve the rest.
+Workers left idle by the other accounts are used by whoever has work.
+
+A task is a callable returning an iterable of metric families, and of
+follow-up tasks: a task listing instances may return one task per batch
+of them, which are queued for its account. When the
+scrape budget runs out, queued tasks are skipped and running tasks are
+abandoned: they see the deadline through 'time_left' and stop at their
+next API call. Until they do, abandoned tasks count against the share of
+their account and hold spare workers, the pool has twice 'pool_size'
+workers so that they do not starve later collections.
+'''
+
+context = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def time_left():
+    '''
+    Seconds left until the deadline of the running task, None without a
+    deadline.
+    '''
+    deadline = getattr(context, 'deadline', None)
+    return None if deadline is None else deadline - time.time()
+
+
+def check_deadline(what):
+    left = time_left()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded('Scrape budget exhausted before {}'.format(what))
+
+
+class FairScheduler(object):
+
+    def __init__(self, pool_size=10):
+        self.pool_size = pool_size
+        self.max_workers = pool_size * 2
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='aliyun-exporter')
+        # unfinished tasks of every account, across concurrent and timed out runs
+        self.condition = threading.Condition()
+        self.busy = Counter()
+
+    def run(self, tasks: dict, timeout=None, skipped: Counter = None):
+        '''
+        Run the tasks of every account and yield (account, families) in the
+        order of completion. The number of skipped tasks of every account is
+        added to 'skipped'.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        queues = OrderedDict((account, deque(t)) for account, t in tasks.items() if len(t) > 0)
+        order = deque(queues)
+        running = dict()
+        while queues or running:
+            with self.condition:
+                while True:
+                    self.dispatch(queues, order, running, deadline)
+                    done = [future for future in running if future.done()]
+                    if done or not (queues or running):
+                        break
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    # woken up whenever a task of any run finishes
+                    self.condition.wait(remaining)
+            if not done:
+                break
+            for future in done:
+                account = running.pop(future)
+                families = []
+                for item in future.result():
+                    if callable(item):
+                        queues.setdefault(account, deque()).append(item)
+                    else:
+                        families.append(item)
+                yield account, families
+        if not queues and not running:
+            return
+        logging.warning('Scrape budget of {}s exhausted, {} tasks skipped'.format(
+            timeout, len(running) + sum(len(q) for q in queues.values())))
+        for account, queue in queues.items():
+            if skipped is not None:
+                skipped[account] += len(queue)
+        for future, account in running.items():
+            future.cancel()
+            if skipped is not None:
+                skipped[account] += 1
+
+    def dispatch(self, queues, order, running, deadline):
+        while queues and len(running) < self.pool_size and sum(self.busy.values()) < self.max_workers:
+            share = max(1, self.pool_size // len(queues))
+            candidates = [a for a in order if a in queues]
+            account = next((a for a in candidates if self.busy[a] < share), candidates[0])
+            order.remove(account)
+            order.append(account)
+            queue = queues[account]
+            task = queue.popleft()
+            if len(queue) == 0:
+                del queues[account]
+            self.busy[account] += 1
+            future = self.executor.submit(execute, task, deadline)
+            running[future] = account
+            future.add_done_callback(lambda f, account=account: self.release(account))
+
+    def release(self, account):
+        with self.condition:
+            self.busy[account] -= 1
+            if self.busy[account] <= 0:
+                del self.busy[account]
+            self.condition.notify_all()
+
+
+def execute(task, deadline=None):
+    context.deadline = deadline
+    try:
+        return list(task())
+    except Exception as e:
+        logging.error('Error running collection task', exc_info=e)
+        return []
+    finally:
+        context.deadline = None
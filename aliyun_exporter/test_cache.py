@@ -0,0 +1,51 @@
+from aliyun_exporter.cache import PointCache
+
+
+def point(instance, average, timestamp=1000):
+    return {'timestamp': timestamp, 'userId': '1', 'instanceId': instance, 'Average': average, 'Maximum': average}
+
+
+def test_update_in_place():
+    cache = PointCache()
+    columns = cache.update('acs_ecs', 'cpu', 60, [point('a', 1), point('b', 2)], ['userId', 'instanceId'],
+                           ['Average', 'Maximum'])
+    assert list(columns.samples('Average')) == [(('1', 'a'), 1.0, 1000), (('1', 'b'), 2.0, 1000)]
+
+    cache.update('acs_ecs', 'cpu', 60, [point('b', 4, 2000), point('a', 3, 2000)], ['userId', 'instanceId'],
+                 ['Average', 'Maximum'])
+    assert cache.get('acs_ecs', 'cpu', 60) is columns
+    assert list(columns.samples('Maximum')) == [(('1', 'a'), 3.0, 2000), (('1', 'b'), 4.0, 2000)]
+    assert list(columns.samples('Minimum')) == []
+
+
+def test_compact_and_shared_labels():
+    cache = PointCache()
+    cache.update('acs_ecs', 'cpu', 60, [point('a', 1), point('b', 2)], ['userId', 'instanceId'], ['Average'])
+    cache.update('acs_ecs', 'mem', 60, [point('a', 1)], ['userId', 'instanceId'], ['Average'])
+    assert len(cache.labels) == 2
+
+    columns = cache.update('acs_ecs', 'cpu', 60, [point('c', 5)], ['userId', 'instanceId'], ['Average'])
+    assert list(columns.samples('Average')) == [(('1', 'c'), 5.0, 1000)]
+    assert sorted(cache.labels.tuples[i] for i in cache.labels.ids.values()) == [('1', 'a'), ('1', 'c')]
+
+
+def test_missing_measure():
+    cache = PointCache()
+    columns = cache.update('acs_oss', 'latency', 60, [point('a', 1), {'timestamp': 1, 'instanceId': 'b'}],
+                           ['instanceId'], ['Average'])
+    assert len(columns) == 2
+    assert list(columns.samples('Average')) == [(('a',), 1.0, 1000)]
+
+
+def test_aggregate():
+    cache = PointCache()
+    points = [{'timestamp': 1000, 'instanceId': 'a', 'device': '/dev/vda', 'Average': 1.0},
+              {'timestamp': 2000, 'instanceId': 'a', 'device': '/dev/vdb', 'Average': 3.0},
+              {'timestamp': 1000, 'instanceId': 'b', 'device': '/dev/vda', 'Average': 5.0},
+              {'timestamp': 1000, 'instanceId': 'b', 'device': '/dev/vdb'}]
+    columns = cache.update('acs_ecs', 'disk', 60, points, ['instanceId', 'device'], ['Average'])
+    assert list(columns.aggregate('Average', ['instanceId'], ['sum', 'avg', 'max', 'min', 'count'])) == [
+        (('a',), {'sum': 4.0, 'avg': 2.0, 'max': 3.0, 'min': 1.0, 'count': 2}, 2000),
+        (('b',), {'sum': 5.0, 'avg': 5.0, 'max': 5.0, 'min': 5.0, 'count': 1}, 1000)]
+    assert list(columns.aggregate('Average', [], ['count'])) == [((), {'count': 3}, 2000)]
+    assert list(columns.aggregate('Maximum', [], ['count'])) == []
@@ -0,0 +1,207 @@
+import threading
+import time
+
+import pytest
+from prometheus_client.core import GaugeMetricFamily
+
+from aliyun_exporter.collector import CollectorConfig, Selection, parse_metric
+from aliyun_exporter.limiter import CircuitOpenError
+
+
+def test_accounts_config(credential):
+    config = CollectorConfig(rate_limit=5, metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'}]},
+                             accounts=[{'name': 'a', 'credential': credential},
+                                       {'name': 'b', 'credential': credential, 'rate_limit': 1, 'metrics': {}}])
+    assert [c.name for c in config.accounts] == ['a', 'b']
+    assert config.accounts[0].rate_limit == 5
+    assert config.accounts[0].metrics == {'acs_ecs_dashboard': [{'name': 'CPUUtilization'}]}
+    assert config.accounts[1].rate_limit == 1
+    assert config.accounts[1].metrics == {}
+
+
+def test_account_label(make_collector, credential):
+    collector = make_collector(metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'}]},
+                               accounts=[{'name': 'a', 'credential': credential},
+                                         {'name': 'b', 'credential': credential}])
+    for name, account in collector.accounts.items():
+        account.query_metric = lambda project, metric, period, name=name: [
+            {'timestamp': 1, 'instanceId': 'i-' + name, 'Average': 1.0}]
+    families = {f.name: f for f in collector.collect()}
+    assert sorted([s.labels for s in families['aliyun_acs_ecs_dashboard_CPUUtilization'].samples],
+                  key=lambda labels: labels['account']) == [
+        {'instanceId': 'i-a', 'account': 'a'}, {'instanceId': 'i-b', 'account': 'b'}]
+    assert len(families['aliyun_acs_ecs_dashboard_CPUUtilization_up'].samples) == 2
+
+
+def test_serve_last_known_when_circuit_open(make_collector):
+    collector = make_collector([{'timestamp': 1, 'instanceId': 'i-1', 'Average': 1.0}],
+                               metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'}]})
+    account = collector.accounts[None]
+    list(collector.collect())
+
+    def circuit_open(project, metric, period):
+        raise CircuitOpenError('Cms', 'cn-hangzhou')
+    account.query_metric = circuit_open
+    families = {f.name: f for f in collector.collect()}
+    assert [s.value for s in families['aliyun_acs_ecs_dashboard_CPUUtilization'].samples] == [1.0]
+    assert families['aliyun_acs_ecs_dashboard_CPUUtilization_up'].samples[0].value == 0
+
+
+def test_info_served_from_cache_when_circuit_open(make_collector):
+    collector = make_collector(info_metrics=['ecs'])
+    account = collector.accounts[None]
+    gauge = GaugeMetricFamily('aliyun_meta_ecs_info', '', labels=['InstanceId'])
+    gauge.add_metric(['i-1'], 1.0)
+    account.info_provider.get_metrics = lambda resource, client: gauge
+    families = {f.name: f for f in collector.collect()}
+    assert families['aliyun_meta_ecs_info_up'].samples[0].labels == {'region': 'cn-hangzhou'}
+    assert families['aliyun_meta_ecs_info_up'].samples[0].value == 1
+
+    def circuit_open(resource, client):
+        raise CircuitOpenError('Ecs', 'cn-hangzhou')
+    account.info_provider.get_metrics = circuit_open
+    families = {f.name: f for f in collector.collect()}
+    assert len(families['aliyun_meta_ecs_info'].samples) == 1
+    assert families['aliyun_meta_ecs_info_up'].samples[0].value == 0
+
+    def failed_listing(resource, client):
+        raise IndexError('page 2 failed')
+    account.info_provider.get_metrics = failed_listing
+    families = {f.name: f for f in collector.collect()}
+    assert len(families['aliyun_meta_ecs_info'].samples) == 1
+    assert families['aliyun_meta_ecs_info_up'].samples[0].value == 0
+
+
+def test_selection():
+    selection = Selection.from_params({'project': ['acs_rds_dashboard']})
+    assert selection.has_project('acs_rds_dashboard')
+    assert not selection.has_project('acs_ecs_dashboard')
+    assert not selection.has_resource('ecs')
+
+    selection = Selection.from_params({'info': ['only']})
+    assert not selection.has_project('acs_rds_dashboard')
+    assert selection.has_resource('ecs')
+
+    selection = Selection.from_params({'info': ['exclude'], 'account': ['a']})
+    assert selection.has_project('acs_rds_dashboard')
+    assert not selection.has_resource('ecs')
+    assert selection.has_account('a') and not selection.has_account('b')
+
+    assert Selection().has_project('acs_rds_dashboard') and Selection().has_resource('ecs')
+
+
+def test_coalesce_concurrent_collections(make_collector):
+    calls = []
+
+    def slow_query(project, metric, period):
+        calls.append(metric)
+        time.sleep(0.2)
+        return [{'timestamp': 1, 'instanceId': 'i-1', 'Average': 1.0}]
+    collector = make_collector(slow_query, metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'}]})
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(list(collector.collect()))) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert len(results) == 3 and all(len(r) == len(results[0]) for r in results)
+
+    families = [f.name for f in collector.collect(Selection(info='only'))]
+    assert 'aliyun_acs_ecs_dashboard_CPUUtilization' not in families
+    assert len(calls) == 1
+
+
+def test_overlapping_selections(make_collector):
+    calls = []
+
+    def slow_query(project, metric, period):
+        calls.append(metric)
+        time.sleep(0.2)
+        return [{'timestamp': 1, 'instanceId': 'i-{}'.format(i), 'Average': 1.0} for i in range(3)]
+    collector = make_collector(slow_query, max_series=2, metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'}]})
+
+    results = []
+    selections = [Selection(), Selection(projects=['acs_ecs_dashboard'])]
+    threads = [threading.Thread(target=lambda s=s: results.append({f.name: f for f in collector.collect(s)}))
+               for s in selections]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # the second collection serves what the first one fetched
+    assert len(calls) == 1
+    for families in results:
+        assert len(families['aliyun_acs_ecs_dashboard_CPUUtilization'].samples) == 2
+        assert [s.value for s in families['aliyun_exporter_dropped_series'].samples] == [1]
+
+
+def test_measures_and_deduplication(make_collector):
+    calls = []
+
+    def query(project, metric, period):
+        calls.append((metric, period))
+        return [{'timestamp': 1, 'instanceId': 'i-1', 'Average': 2.0, 'Maximum': 3.0, 'Minimum': 1.0}]
+    collector = make_collector(query, metrics={'acs_ecs_dashboard': [
+        {'name': 'CPUUtilization', 'measures': ['Average', 'Maximum']},
+        {'name': 'CPUUtilization', 'rename': 'cpu', 'measures': ['Minimum'], 'measure_label': True},
+        {'name': 'CPUUtilization', 'period': 300},
+    ]})
+    families = {f.name: f for f in collector.collect()}
+    assert sorted(calls) == [('CPUUtilization', 60), ('CPUUtilization', 300)]
+    assert families['aliyun_acs_ecs_dashboard_CPUUtilization_Average'].samples[0].value == 2.0
+    assert families['aliyun_acs_ecs_dashboard_CPUUtilization_Maximum'].samples[0].value == 3.0
+    assert families['aliyun_acs_ecs_dashboard_cpu'].samples[0].labels == {'instanceId': 'i-1', 'measure': 'Minimum'}
+    assert families['aliyun_acs_ecs_dashboard_CPUUtilization'].samples[0].value == 2.0
+    assert families['aliyun_acs_ecs_dashboard_cpu_up'].samples[0].value == 1
+
+
+def test_aggregate(make_collector):
+    collector = make_collector([{'timestamp': 1, 'instanceId': 'i-1', 'device': '/dev/vda', 'Average': 10.0},
+                                {'timestamp': 1, 'instanceId': 'i-1', 'device': '/dev/vdb', 'Average': 30.0},
+                                {'timestamp': 1, 'instanceId': 'i-2', 'device': '/dev/vda', 'Average': 20.0}],
+                               metrics={'acs_ecs_dashboard': [
+                                   {'name': 'diskusage_utilization', 'drop_raw': True,
+                                    'aggregate': [{'by': ['instanceId'], 'ops': ['max']},
+                                                  {'name': 'disk_fleet', 'ops': ['avg', 'count']}]},
+                               ]})
+    families = {f.name: f for f in collector.collect()}
+    assert 'aliyun_acs_ecs_dashboard_diskusage_utilization' not in families
+    assert [(s.labels, s.value) for s in families['aliyun_acs_ecs_dashboard_diskusage_utilization_max'].samples] == [
+        ({'instanceId': 'i-1'}, 30.0), ({'instanceId': 'i-2'}, 20.0)]
+    assert families['aliyun_acs_ecs_dashboard_disk_fleet_avg'].samples[0].value == 20.0
+    assert families['aliyun_acs_ecs_dashboard_disk_fleet_count'].samples[0].value == 3
+    assert families['aliyun_acs_ecs_dashboard_diskusage_utilization_up'].samples[0].value == 1
+
+
+def test_duplicate_aggregate_names(make_collector):
+    metric = {'name': 'diskusage_utilization',
+              'aggregate': [{'by': ['instanceId'], 'ops': ['max']}, {'ops': ['max', 'avg']}]}
+    with pytest.raises(Exception, match='generate diskusage_utilization_max twice'):
+        parse_metric(metric)
+    # the config is parsed when the collector is built, not on every scrape
+    with pytest.raises(Exception, match='generate diskusage_utilization_max twice'):
+        make_collector(metrics={'acs_ecs_dashboard': [metric]})
+    spec = parse_metric({'name': 'diskusage_utilization',
+                         'aggregate': [{'by': ['instanceId'], 'ops': ['max']}, {'name': 'disk_fleet', 'ops': ['max']}]})
+    assert len(spec.aggregate) == 2
+
+
+def test_push_timestamps(make_collector):
+    collector = make_collector([{'timestamp': 1548777660000, 'instanceId': 'i-1', 'Average': 1.0}],
+                               metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'}]},
+                               push={'url': 'http://localhost:9090/api/v1/write'})
+    families = {f.name: f for f in collector.collect()}
+    assert families['aliyun_acs_ecs_dashboard_CPUUtilization'].samples[0].timestamp == 1548777660.0
+
+
+def test_push_not_bound_to_scrape_timeout(make_collector):
+    def slow_query(project, metric, period):
+        time.sleep(0.3)
+        return [{'timestamp': 1, 'instanceId': 'i-1', 'Average': 1.0}]
+    collector = make_collector(slow_query, scrape_timeout=0.1, metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'}]},
+                               push={'url': 'http://localhost:9090/api/v1/write'})
+    families = {f.name: f for f in collector.collect()}
+    assert len(families['aliyun_acs_ecs_dashboard_CPUUtilization'].samples) == 1
+    assert families['aliyun_exporter_skipped_tasks'].samples[0].value == 0
@@ -0,0 +1,23 @@
+import json
+
+from aliyun_exporter.decoder import backend, benchmark, decode_datapoints, decode_page
+
+
+def test_decode_datapoints():
+    points = [{'timestamp': 1548777660000, 'instanceId': 'i-1', 'Average': 1.5}]
+    resp = json.dumps({'Code': '200', 'Datapoints': json.dumps(points)}).encode('utf-8')
+    assert decode_datapoints(resp) == points
+    assert decode_datapoints(b'{"Code": "403", "Message": "Forbidden"}') is None
+
+
+def test_decode_page():
+    resp = json.dumps({'Items': {'DBInstance': [{'DBInstanceId': 'rm-1', 'Tags': {'Tag': []}}]}})
+    assert decode_page(resp, lambda data: data['Items']['DBInstance']) == [{'DBInstanceId': 'rm-1', 'Tags': {'Tag': []}}]
+    assert decode_page(resp, lambda data: data['Items']['DBInstance'],
+                       lambda instance: {'DBInstanceId': instance['DBInstanceId']}) == [{'DBInstanceId': 'rm-1'}]
+
+
+def test_benchmark():
+    results = benchmark(series=1000, rounds=1)
+    assert set(results) == {'json', backend}
+    assert all(isinstance(seconds, float) and seconds >= 0 for seconds in results.values())
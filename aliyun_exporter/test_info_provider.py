@@ -0,0 +1,79 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from aliyun_exporter.info_provider import InfoProvider, resource_handlers, new_request
+from aliyun_exporter.limiter import CircuitOpenError
+from aliyun_exporter.utils import SeriesGuard
+
+
+def test_sdk_not_imported_eagerly():
+    code = 'import sys, aliyun_exporter.info_provider; print(any(m.startswith("aliyunsdkecs") for m in sys.modules))'
+    out = subprocess.check_output([sys.executable, '-c', code])
+    assert out.strip() == b'False'
+
+
+def test_resource_handlers():
+    for resource, handler in resource_handlers.items():
+        if handler.request is None:
+            continue
+        assert new_request(resource).get_action_name()
+
+
+class FakeClient(object):
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def do_action_with_exception(self, req):
+        return json.dumps(self.pages[req.get_query_params()['PageNumber'] - 1])
+
+
+def ecs_page(count):
+    return {'Instances': {'Instance': [
+        {'InstanceId': 'i-{}'.format(i), 'Description': 'desc', 'CreationTime': '2020-01-01T00:00Z', 'Cpu': 2}
+        for i in range(count)
+    ]}}
+
+
+def test_info_labels():
+    info_labels = {'ecs': {'exclude': ['Description', 'CreationTime'], 'rename': {'InstanceId': 'instance_id'}}}
+    provider = InfoProvider('ak', 'secret', 'cn-hangzhou', info_labels=info_labels)
+    gauge = provider.get_metrics('ecs', FakeClient([ecs_page(2)]))
+    assert [s.labels for s in gauge.samples] == [{'instance_id': 'i-0', 'Cpu': '2'}, {'instance_id': 'i-1', 'Cpu': '2'}]
+
+    provider = InfoProvider('ak', 'secret', 'cn-hangzhou', info_labels={'ecs': {'include': ['InstanceId']}})
+    gauge = provider.get_metrics('ecs', FakeClient([ecs_page(1)]))
+    assert [s.labels for s in gauge.samples] == [{'InstanceId': 'i-0'}]
+
+
+def test_info_max_series():
+    guard = SeriesGuard(max_series=150)
+    provider = InfoProvider('ak', 'secret', 'cn-hangzhou', series_guard=guard)
+    gauge = provider.get_metrics('ecs', FakeClient([ecs_page(100), ecs_page(100), ecs_page(0)]))
+    assert len(gauge.samples) == 150
+    assert guard.dropped_gauge().samples[0].value == 50
+    assert guard.dropped == {}
+
+
+class OpenCircuitClient(FakeClient):
+
+    def do_action_with_exception(self, req):
+        if req.get_query_params()['PageNumber'] > 1:
+            raise CircuitOpenError('Ecs', 'cn-hangzhou')
+        return super().do_action_with_exception(req)
+
+
+def test_pager_raises_circuit_open():
+    provider = InfoProvider('ak', 'secret', 'cn-hangzhou')
+    with pytest.raises(CircuitOpenError):
+        provider.get_metrics('ecs', OpenCircuitClient([ecs_page(100), ecs_page(1)]))
+
+
+def test_partial_listing_raises():
+    provider = InfoProvider('ak', 'secret', 'cn-hangzhou')
+    # the second page fails twice, the listing is not cut short
+    with pytest.raises(IndexError):
+        provider.get_metrics('ecs', FakeClient([ecs_page(100)]))
@@ -0,0 +1,68 @@
+import time
+
+import pytest
+from aliyunsdkcore.acs_exception.exceptions import ServerException
+
+from aliyun_exporter.limiter import AdaptiveController, CircuitOpenError
+
+
+def throttle():
+    raise ServerException('Throttling.User', 'Request was denied due to user flow control.', 400)
+
+
+def invalid():
+    raise ServerException('InvalidParameter', 'The specified parameter is not valid.', 400)
+
+
+def test_additive_increase_multiplicative_decrease():
+    controller = AdaptiveController(initial_concurrency=2, max_concurrency=4)
+    endpoint = controller.endpoint('Cms', 'cn-hangzhou')
+    for _ in range(2 + 3):
+        controller.call('Cms', 'cn-hangzhou', lambda: None)
+    assert endpoint.limit == 4
+    for _ in range(10):
+        controller.call('Cms', 'cn-hangzhou', lambda: None)
+    assert endpoint.limit == 4
+
+    with pytest.raises(ServerException):
+        controller.call('Cms', 'cn-hangzhou', throttle)
+    assert endpoint.limit == 2
+    with pytest.raises(ServerException):
+        controller.call('Cms', 'cn-hangzhou', invalid)
+    # rejected requests are neither healthy nor failed calls
+    assert endpoint.limit == 2
+    assert endpoint.failures == 1
+
+
+def test_circuit_breaker():
+    controller = AdaptiveController(failure_threshold=2, cool_down=0.1)
+    for _ in range(2):
+        with pytest.raises(ServerException):
+            controller.call('Ecs', 'cn-beijing', throttle)
+    assert controller.is_open('Ecs', 'cn-beijing')
+    assert not controller.is_open('Ecs', 'cn-hangzhou')
+    with pytest.raises(CircuitOpenError):
+        controller.call('Ecs', 'cn-beijing', lambda: None)
+
+    time.sleep(0.1)
+    with pytest.raises(ServerException):
+        controller.call('Ecs', 'cn-beijing', throttle)
+    assert controller.is_open('Ecs', 'cn-beijing')
+
+    time.sleep(0.1)
+    assert controller.call('Ecs', 'cn-beijing', lambda: 'ok') == 'ok'
+    assert controller.call('Ecs', 'cn-beijing', lambda: 'ok') == 'ok'
+    assert not controller.is_open('Ecs', 'cn-beijing')
+
+
+def test_rejected_trial_does_not_close_circuit():
+    controller = AdaptiveController(failure_threshold=1, cool_down=0.1)
+    with pytest.raises(ServerException):
+        controller.call('Ecs', 'cn-beijing', throttle)
+    time.sleep(0.1)
+    with pytest.raises(ServerException):
+        controller.call('Ecs', 'cn-beijing', invalid)
+    endpoint = controller.endpoint('Ecs', 'cn-beijing')
+    assert endpoint.failures == 1 and endpoint.open_until > 0 and not endpoint.trial
+    controller.call('Ecs', 'cn-beijing', lambda: None)
+    assert endpoint.failures == 0 and endpoint.open_until == 0
@@ -0,0 +1,137 @@
+import json
+
+from prometheus_client.core import GaugeMetricFamily
+
+from aliyun_exporter.collector import Selection
+from aliyun_exporter.performance import parse_time
+
+
+def rds_response(instance_id):
+    return {'PerformanceKeys': {'PerformanceKey': [
+        {'Key': 'MySQL_Sessions', 'ValueFormat': 'active_session&total_session',
+         'Values': {'PerformanceValue': [{'Value': '1&10', 'Date': '2019-01-29T16:00:00Z'},
+                                         {'Value': '2&20', 'Date': '2019-01-29T16:01:00Z'}]}},
+        {'Key': 'MySQL_IOPS', 'ValueFormat': 'io',
+         'Values': {'PerformanceValue': [{'Value': '3', 'Date': '2019-01-29T16:01:00Z'}]}},
+    ]}}
+
+
+def test_batches_share_families(make_collector):
+    collector = make_collector(performance={'batch_size': 2},
+                               metrics={'rds_performance': [{'name': 'MySQL_Sessions'}, {'name': 'MySQL_IOPS'}]})
+    account = collector.accounts[None]
+    account.instance_ids = lambda resource, id_key, region: ['rm-1', 'rm-2', 'rm-3']
+    windows = set()
+
+    def query(region, instance_id, start, end):
+        windows.add((start, end))
+        return rds_response(instance_id)
+    performance = account.special_collectors['rds_performance']
+    performance.query = query
+
+    # the instances are listed in a task, which returns a task per batch
+    listing, = account.tasks(Selection())
+    assert len(list(listing())) == 2
+    families = {f.name: f for f in collector.collect()}
+    sessions = families['aliyun_rds_performance_MySQL_Sessions_active_session']
+    assert sorted((s.labels['instanceId'], s.value) for s in sessions.samples) == [('rm-1', 2.0), ('rm-2', 2.0),
+                                                                                   ('rm-3', 2.0)]
+    assert len(families['aliyun_rds_performance_MySQL_Sessions_total_session'].samples) == 3
+    assert len(families['aliyun_rds_performance_MySQL_IOPS_value'].samples) == 3
+    assert len(windows) == 1
+    start, end = windows.pop()
+    assert end % 60 == 0 and end - start == 300
+
+
+def test_malformed_response_skips_only_its_instance(make_collector):
+    collector = make_collector(performance={'batch_size': 3}, metrics={'rds_performance': [{'name': 'MySQL_IOPS'}]})
+    account = collector.accounts[None]
+    account.instance_ids = lambda resource, id_key, region: ['rm-1', 'rm-2', 'rm-3']
+    responses = {'rm-1': rds_response('rm-1'), 'rm-2': {'PerformanceKeys': {}},
+                 'rm-3': {'PerformanceKeys': {'PerformanceKey': [
+                     {'Key': 'MySQL_IOPS', 'ValueFormat': 'io',
+                      'Values': {'PerformanceValue': [{'Value': 'n/a', 'Date': '2019-01-29T16:01:00Z'}]}}]}}}
+    account.special_collectors['rds_performance'].query = lambda region, instance_id, start, end: responses[
+        instance_id]
+
+    families = {f.name: f for f in collector.collect()}
+    assert [s.labels['instanceId'] for s in families['aliyun_rds_performance_MySQL_IOPS_value'].samples] == ['rm-1']
+
+
+def test_redis_and_polardb(make_collector):
+    collector = make_collector(metrics={'redis_performance': [{'name': 'UsedMemory'}],
+                                        'polardb_performance': [{'name': 'PolarDBCPU'}]})
+    account = collector.accounts[None]
+    account.instance_ids = lambda resource, id_key, region: {'redis': ['r-1'], 'polardb': ['pc-1']}[resource]
+    account.special_collectors['redis_performance'].query = lambda region, instance_id, start, end: {
+        'MonitorHistory': json.dumps({'2019-01-29T16:00:00Z': {'UsedMemory': '100', 'CpuUsage': '1'},
+                                      '2019-01-29T16:01:00Z': {'UsedMemory': '200', 'CpuUsage': '2'}})}
+    account.special_collectors['polardb_performance'].query = lambda region, instance_id, start, end: {
+        'PerformanceKeys': {'PerformanceItem': [
+            {'Measurement': 'PolarDBCPU', 'MetricName': 'cpu_ratio', 'DBNodeId': node,
+             'Points': {'PerformanceItemValue': [{'Value': 5, 'Timestamp': 1548777660000}]}}
+            for node in ['pi-1', 'pi-2']]}}
+
+    families = {f.name: f for f in collector.collect()}
+    assert [(s.labels, s.value) for s in families['aliyun_redis_performance_UsedMemory'].samples] == [
+        ({'instanceId': 'r-1'}, 200.0)]
+    assert 'aliyun_redis_performance_CpuUsage' not in families
+    assert [s.labels for s in families['aliyun_polardb_performance_PolarDBCPU_cpu_ratio'].samples] == [
+        {'clusterId': 'pc-1', 'nodeId': 'pi-1'}, {'clusterId': 'pc-1', 'nodeId': 'pi-2'}]
+
+
+def test_inventory_cache(make_collector):
+    collector = make_collector(info_labels={'rds': {'rename': {'DBInstanceId': 'id'}}},
+                               metrics={'rds_performance': [{'name': 'MySQL_Sessions'}]}, info_metrics=['rds'])
+    config = collector.config
+    account = collector.accounts[None]
+    calls = []
+
+    def get_metrics(resource, client, labels=None, series_guard=None):
+        calls.append(labels)
+        names = [(labels or {}).get('rename', {}).get('DBInstanceId', 'DBInstanceId')]
+        gauge = GaugeMetricFamily('aliyun_meta_rds_info', '', labels=names)
+        gauge.add_metric(['rm-1'], 1.0)
+        return gauge
+    account.info_provider.get_metrics = get_metrics
+
+    assert account.instance_ids('rds', 'DBInstanceId', 'cn-hangzhou') == ['rm-1']
+    assert account.instance_ids('rds', 'DBInstanceId', 'cn-hangzhou') == ['rm-1']
+    assert calls == [{'include': ['DBInstanceId']}]
+
+    # the info metric refreshes the inventory, its renamed labels are mapped back
+    account.inventory.clear()
+    account.info_provider.info_labels = config.info_labels
+    account.info_provider.get_metrics = lambda resource, client: get_metrics(resource, client,
+                                                                             config.info_labels['rds'])
+    list(account.info_generator('rds', 'cn-hangzhou'))
+    assert account.instance_ids('rds', 'DBInstanceId', 'cn-hangzhou') == ['rm-1']
+    assert len(calls) == 2
+
+
+def test_inventory_not_cached_when_truncated_or_failed(make_collector):
+    account = make_collector(max_series=1, metrics={'rds_performance': [{'name': 'MySQL_Sessions'}]}).accounts[None]
+    responses = [['rm-1', 'rm-2'], None]
+
+    def get_metrics(resource, client, labels=None, series_guard=None):
+        ids = responses.pop(0)
+        if ids is None:
+            raise RuntimeError('page 2 failed')
+        gauge = GaugeMetricFamily('aliyun_meta_rds_info', '', labels=['DBInstanceId'])
+        for instance_id in ids:
+            series_guard.add_metric(gauge, [instance_id], 1.0)
+        return gauge
+    account.info_provider.get_metrics = get_metrics
+
+    # the listing has its own guard, max_series of the account does not truncate it
+    assert account.instance_ids('rds', 'DBInstanceId', 'cn-hangzhou') == ['rm-1', 'rm-2']
+    # a failed listing keeps the last known inventory
+    account.inventory[('rds', 'cn-hangzhou')] = (0, account.inventory[('rds', 'cn-hangzhou')][1])
+    assert account.instance_ids('rds', 'DBInstanceId', 'cn-hangzhou') == ['rm-1', 'rm-2']
+    assert account.inventory[('rds', 'cn-hangzhou')][0] == 0
+
+
+def test_parse_time():
+    assert parse_time('2019-01-29T16:01:00Z') == 1548777660000
+    assert parse_time('2019-01-29T16:01Z') == 1548777660000
+    assert parse_time('') == 0
@@ -0,0 +1,115 @@
+import pytest
+from prometheus_client.core import GaugeMetricFamily
+
+from aliyun_exporter.collector import CollectorConfig
+from aliyun_exporter.planner import Planner, format_plan
+from aliyun_exporter.web import create_app
+
+
+def test_plan_calls_and_duration(credential):
+    config = CollectorConfig(credential=dict(credential), rate_limit=2, pool_size=2, scrape_timeout=1,
+                             metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'},
+                                                            {'name': 'CPUUtilization', 'measure': 'Maximum'},
+                                                            {'name': 'memory_usedutilization'}]},
+                             info_metrics=['ecs'])
+    plan, = Planner(config, interval=1, quotas={'Cms': 100}).plan()
+    assert [(e.kind, e.product, e.calls) for e in plan.entries] == [('metric', 'Cms', 1), ('metric', 'Cms', 1),
+                                                                    ('info', 'Ecs', 1)]
+    assert plan.calls == {'Cms': 2, 'Ecs': 1}
+    assert plan.duration == 1.0
+    assert plan.series is None
+    assert any('exceed the quota 100' in w for w in plan.warnings)
+    assert not any('exceeds the interval' in w for w in plan.warnings)
+    assert 'Cms calls per 1s interval: 2' in format_plan([plan], 1)
+
+
+def test_plan_series_from_cache(make_collector):
+    collector = make_collector([{'timestamp': 1, 'instanceId': 'i-{}'.format(i), 'Average': 1.0, 'Maximum': 2.0}
+                                for i in range(3)], max_series=2,
+                               metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization',
+                                                               'measures': ['Average', 'Maximum']}],
+                                        'acs_rds_dashboard': [{'name': 'CpuUsage', 'drop_raw': True,
+                                                               'aggregate': {'ops': ['max', 'avg']}}],
+                                        'rds_performance': [{'name': 'MySQL_Sessions'}]})
+    account = collector.accounts[None]
+    account.instance_ids = lambda resource, id_key, region: []
+    list(collector.collect())
+    gauge = GaugeMetricFamily('aliyun_meta_rds_info', '', labels=['DBInstanceId'])
+    for i in range(250):
+        gauge.add_metric(['rm-{}'.format(i)], 1.0)
+    account.info_cache[('rds', 'cn-hangzhou')] = gauge
+
+    plan, = Planner(collector.config, collector).plan()
+    entries = {e.name: e for e in plan.entries}
+    cpu = entries['acs_ecs_dashboard/CPUUtilization (60s)']
+    assert cpu.series == 6
+    assert cpu.warnings == ['3 series per family exceed max_series 2']
+    assert entries['acs_rds_dashboard/CpuUsage (60s)'].series == 2
+    special = entries['rds_performance (cn-hangzhou)']
+    assert special.product == 'Rds' and special.series == 250
+    assert special.calls == 250 + 3 * 60 / 600
+
+
+def test_planner_page(make_collector):
+    collector = make_collector(metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'}]})
+    app = create_app(collector.config, collector).app.test_client()
+    body = app.get('/planner').get_data(as_text=True)
+    assert 'acs_ecs_dashboard/CPUUtilization (60s)' in body
+
+    body = app.post('/planner', data={'config': 'metrics:\n  acs_rds_dashboard:\n  - name: CpuUsage\n',
+                                      'interval': '30'}).get_data(as_text=True)
+    assert 'acs_rds_dashboard/CpuUsage (60s)' in body
+    assert 'Cms: 1.00 calls per 30s' in body
+
+
+def test_invalid_interval_and_latency(make_collector):
+    collector = make_collector(metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'}]})
+    with pytest.raises(ValueError):
+        Planner(collector.config, interval=0)
+    with pytest.raises(ValueError):
+        Planner(collector.config, latency=-1)
+
+    app = create_app(collector.config, collector).app.test_client()
+    response = app.get('/planner?interval=0')
+    assert response.status_code == 200
+    assert 'interval must be positive' in response.get_data(as_text=True)
+    assert 'latency must not be negative' in app.get('/planner?latency=-1').get_data(as_text=True)
+
+
+def test_accounts_share_the_pool(credential):
+    metrics = {'acs_ecs_dashboard': [{'name': 'metric_{}'.format(i)} for i in range(40)]}
+    config = CollectorConfig(pool_size=10, scrape_timeout=10, metrics=metrics,
+                             accounts=[{'name': 'a{}'.format(i), 'credential': credential} for i in range(30)])
+    planner = Planner(config, latency=1)
+    plans = planner.plan()
+    assert [p.duration for p in plans] == [4.0] * 30
+    assert not any(p.warnings for p in plans)
+    total = planner.total(plans)
+    assert total.calls == 1200
+    assert total.duration == 120.0
+    assert total.warnings == ['expected duration 120.0s exceeds scrape_timeout 10s',
+                              'expected duration 120.0s exceeds the interval 60s']
+    assert 'All accounts: 1200 calls per 60s interval, expected duration: 120.0s' in format_plan(plans, 60, total)
+
+
+def test_failed_listing(make_collector):
+    collector = make_collector(info_metrics=['ecs'])
+
+    def unreachable(resource, client, labels=None, series_guard=None):
+        raise ConnectionError('unreachable')
+    collector.accounts[None].info_provider.get_metrics = unreachable
+    plan, = Planner(collector.config, collector, fetch_inventory=True).plan()
+    entry, = plan.entries
+    assert entry.series is None
+    assert entry.warnings == ['listing ecs in cn-hangzhou failed: unreachable']
+
+
+def test_planner_page_invalid_config(make_collector):
+    collector = make_collector(metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'}]})
+    app = create_app(collector.config, collector).app.test_client()
+    for text in ['info_metrics: [foo]\n', 'metrics:\n  acs_ecs_dashboard:\n  - rename: cpu\n',
+                 'rate_limit: 0\nmetrics:\n  acs_ecs_dashboard:\n  - name: CPUUtilization\n',
+                 'metrics:\n  acs_ecs_dashboard:\n  - name: CPUUtilization\n    aggregate: {ops: [median]}\n']:
+        response = app.post('/planner', data={'config': text})
+        assert response.status_code == 200
+        assert 'Oops!' in response.get_data(as_text=True)
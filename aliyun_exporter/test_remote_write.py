@@ -0,0 +1,116 @@
+import os
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from prometheus_client.core import GaugeMetricFamily
+
+from aliyun_exporter.remote_write import RemoteWriter, snappy_compress
+
+
+def read_varint(data, i):
+    n = shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 0x7f) << shift
+        shift += 7
+        if b < 0x80:
+            return n, i
+
+
+def snappy_decompress(data):
+    length, i = read_varint(data, 0)
+    out = bytearray()
+    while i < len(data):
+        tag = data[i]
+        i += 1
+        if tag & 3 == 0:
+            n = tag >> 2
+            if n >= 60:
+                size = n - 59
+                n = int.from_bytes(data[i:i + size], 'little')
+                i += size
+            out += data[i:i + n + 1]
+            i += n + 1
+        else:
+            assert tag & 3 == 2
+            n = (tag >> 2) + 1
+            offset = struct.unpack('<H', data[i:i + 2])[0]
+            i += 2
+            for _ in range(n):
+                out.append(out[-offset])
+    assert len(out) == length
+    return bytes(out)
+
+
+def read_fields(data):
+    i = 0
+    while i < len(data):
+        key, i = read_varint(data, i)
+        if key & 7 == 2:
+            n, i = read_varint(data, i)
+            yield key >> 3, data[i:i + n]
+            i += n
+        elif key & 7 == 1:
+            yield key >> 3, data[i:i + 8]
+            i += 8
+        else:
+            n, i = read_varint(data, i)
+            yield key >> 3, n
+
+
+def decode_write_request(data):
+    result = []
+    for _, series in read_fields(data):
+        labels = dict()
+        samples = []
+        for number, payload in read_fields(series):
+            if number == 1:
+                label = dict(read_fields(payload))
+                labels[label[1].decode('utf-8')] = label[2].decode('utf-8')
+            else:
+                sample = dict(read_fields(payload))
+                samples.append((struct.unpack('<d', sample[1])[0], sample[2]))
+        result.append((labels, samples))
+    return result
+
+
+def test_snappy_roundtrip():
+    for data in [b'', b'a', b'abcd' * 1000, os.urandom(5000), b'aliyun_acs_ecs_dashboard' * 10 + os.urandom(100) * 3]:
+        assert snappy_decompress(snappy_compress(data)) == data
+    assert len(snappy_compress(b'abcd' * 1000)) < 300
+
+
+def test_push_to_receiver():
+    received = []
+    statuses = [500, 204]
+
+    class Receiver(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            status = statuses.pop(0) if statuses else 204
+            if status == 204:
+                assert self.headers['Content-Encoding'] == 'snappy'
+                received.extend(decode_write_request(snappy_decompress(body)))
+            self.send_response(status)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Receiver)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    writer = RemoteWriter('http://127.0.0.1:{}/api/v1/write'.format(server.server_port), shards=1,
+                          batch_deadline=0.1)
+    gauge = GaugeMetricFamily('aliyun_acs_ecs_dashboard_CPUUtilization', '', labels=['instanceId'])
+    gauge.add_metric(['i-1'], 1.5, 1548777660.0)
+    gauge.add_metric(['i-2'], 2.5)
+    writer.write([gauge], default_timestamp=1548777700.0)
+    writer.stop()
+    server.shutdown()
+
+    assert sorted(received, key=lambda s: s[0]['instanceId']) == [
+        ({'__name__': 'aliyun_acs_ecs_dashboard_CPUUtilization', 'instanceId': 'i-1'}, [(1.5, 1548777660000)]),
+        ({'__name__': 'aliyun_acs_ecs_dashboard_CPUUtilization', 'instanceId': 'i-2'}, [(2.5, 1548777700000)]),
+    ]
@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from aliyun_exporter.limiter import AdaptiveController
+from aliyun_exporter.scheduler import DeadlineExceeded, FairScheduler, check_deadline, context, time_left
+
+
+def sleeper(account, started, lock, duration=0.01):
+    def task():
+        with lock:
+            started.append(account)
+        time.sleep(duration)
+        return [account]
+    return task
+
+
+def test_fair_dispatch():
+    started = []
+    lock = threading.Lock()
+    tasks = {'big': [sleeper('big', started, lock) for _ in range(20)],
+             'small': [sleeper('small', started, lock) for _ in range(4)]}
+    results = list(FairScheduler(pool_size=4).run(tasks))
+    assert Counter(account for account, _ in results) == {'big': 20, 'small': 4}
+    # the small account is not queued behind the big one
+    assert started[:8].count('small') == 4
+
+
+def test_timeout_skips_tasks():
+    started = []
+    lock = threading.Lock()
+    tasks = {'a': [sleeper('a', started, lock, 0.2) for _ in range(10)]}
+    skipped = Counter()
+    results = list(FairScheduler(pool_size=2).run(tasks, timeout=0.3, skipped=skipped))
+    assert len(results) == 2
+    assert skipped['a'] == 8
+
+
+def test_failed_task():
+    def fail():
+        raise Exception('boom')
+    assert list(FairScheduler(pool_size=1).run({None: [fail]})) == [(None, [])]
+
+
+def test_follow_up_tasks():
+    started = []
+    lock = threading.Lock()
+
+    def listing():
+        return ['listed'] + [sleeper('a', started, lock) for _ in range(3)]
+    results = list(FairScheduler(pool_size=2).run({'a': [listing]}))
+    assert results[0] == ('a', ['listed'])
+    assert results[1:] == [('a', ['a'])] * 3
+
+
+def test_timed_out_tasks_do_not_starve_later_runs():
+    scheduler = FairScheduler(pool_size=2)
+    started = []
+    lock = threading.Lock()
+    slow = {'a': [sleeper('a', started, lock, 1) for _ in range(2)]}
+    assert list(scheduler.run(slow, timeout=0.1)) == []
+    assert scheduler.busy['a'] == 2
+
+    skipped = Counter()
+    results = list(scheduler.run({'b': [sleeper('b', started, lock)]}, timeout=0.5, skipped=skipped))
+    assert results == [('b', ['b'])]
+    assert skipped['b'] == 0
+
+
+def test_deadline_is_visible_to_tasks():
+    def task():
+        time.sleep(0.2)
+        check_deadline('the next call')
+        return ['unreachable']
+    assert list(FairScheduler(pool_size=1).run({'a': [task]}, timeout=0.1)) == []
+    time.sleep(0.2)
+    assert time_left() is None
+
+
+def test_acquire_gives_up_at_deadline():
+    endpoint = AdaptiveController(initial_concurrency=1).endpoint('Cms', 'cn-hangzhou')
+    endpoint.acquire()
+    context.deadline = time.time() + 0.1
+    try:
+        with pytest.raises(DeadlineExceeded):
+            endpoint.acquire()
+    finally:
+        context.deadline = None
+    endpoint.release(0.01)
+    assert endpoint.inflight == 0 and not endpoint.trial
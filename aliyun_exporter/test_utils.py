@@ -1,4 +1,9 @@
-from aliyun_exporter.utils import format_metric, format_period
+import threading
+
+from prometheus_client.core import GaugeMetricFamily
+
+from aliyun_exporter.utils import format_metric, format_period, lazy_import, import_durations, SeriesGuard
+
 
 def test_format_metric():
     assert format_metric("") == ""
@@ -12,3 +17,26 @@ def test_format_period():
     assert format_period("3000") == "3000"
     assert format_period("5,10,25,50,100,300") == "5"
     assert format_period("300_00,500_00") == "300_00"
+
+
+def test_lazy_import():
+    module = lazy_import('json')
+    assert module.loads('{}') == {}
+    assert 'json' in import_durations
+    assert lazy_import('json') is module
+
+
+def test_series_guard_counts_concurrent_drops():
+    guard = SeriesGuard(max_series=0)
+    gauge = GaugeMetricFamily('family', '', labels=['a'])
+
+    def add():
+        for i in range(1000):
+            guard.add_metric(gauge, [str(i)], 1.0)
+    threads = [threading.Thread(target=add) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert guard.dropped_gauge().samples[0].value == 4000
+    assert guard.dropped_gauge().samples == []
@@ -0,0 +1,33 @@
+from aliyun_exporter.web import metrics_app
+
+
+def scrape(app, query):
+    status = []
+    body = app({'QUERY_STRING': query}, lambda s, headers: status.append(s))
+    return status[0], b''.join(body).decode('utf-8')
+
+
+def test_filtered_metrics(make_collector):
+    collector = make_collector([{'timestamp': 1, 'instanceId': 'i-1', 'Average': 1.0}],
+                               metrics={'acs_ecs_dashboard': [{'name': 'CPUUtilization'}],
+                                        'acs_rds_dashboard': [{'name': 'CpuUsage'}]})
+    app = metrics_app(collector)
+
+    status, body = scrape(app, 'project=acs_rds_dashboard')
+    assert status == '200 OK'
+    assert 'aliyun_acs_rds_dashboard_CpuUsage{instanceId="i-1"} 1.0' in body
+    assert 'aliyun_acs_ecs_dashboard_CPUUtilization' not in body
+
+    status, body = scrape(app, 'info=everything')
+    assert status == '400 Bad Request'
+
+
+def test_filtered_metrics_disabled_in_push_mode(make_collector):
+    collector = make_collector([{'timestamp': 1, 'instanceId': 'i-1', 'Average': 1.0}],
+                               metrics={'acs_rds_dashboard': [{'name': 'CpuUsage'}]},
+                               push={'url': 'http://localhost:9090/api/v1/write'})
+    app = metrics_app(collector)
+
+    status, body = scrape(app, 'project=acs_rds_dashboard')
+    assert status == '400 Bad Request'
+    assert 'aliyun_acs_rds_dashboard_CpuUsage' not in body
@@ -1,3 +1,12 @@
+import importlib
+import logging
+import threading
+import time
+from functools import partial
+
+from prometheus_client.core import GaugeMetricFamily
+
+
 def format_metric(text: str):
     return text.replace('.', '_')
 
@@ -12,3 +21,92 @@ def try_or_else(op, default):
     except:
         return default
 
+
+'''
+SDK modules are imported on first use, so that an exporter only pays for the
+products it actually collects. The duration of every import is recorded
+and exposed as a metric.
+'''
+import_durations = dict()
+import_lock = threading.Lock()
+
+
+def lazy_import(name: str):
+    if name in import_durations:
+        return importlib.import_module(name)
+    with import_lock:
+        start_time = time.time()
+        module = importlib.import_module(name)
+        if name not in import_durations:
+            import_durations[name] = time.time() - start_time
+            logging.info('Imported {} in {:.3f}s'.format(name, import_durations[name]))
+    return module
+
+
+def import_duration_gauge() -> GaugeMetricFamily:
+    gauge = GaugeMetricFamily('aliyun_exporter_import_duration_seconds',
+                              'Time spent importing SDK modules on first use.', labels=['module'])
+    for name, duration in sorted(import_durations.items()):
+        gauge.add_metric([name], duration)
+    return gauge
+
+
+# dropped series of the collection task running on the current thread
+collection = threading.local()
+
+
+def count_drops(task, dropped: dict):
+    '''
+    Run a collection task, series it and its follow-up tasks drop are
+    counted into 'dropped'.
+    '''
+    collection.dropped = dropped
+    try:
+        return [partial(count_drops, item, dropped) if callable(item) else item for item in task()]
+    finally:
+        collection.dropped = None
+
+
+class SeriesGuard(object):
+    '''
+    SeriesGuard caps the number of series of every metric family.
+
+    Series beyond 'max_series' are dropped while the family is built. Drops
+    are counted per collection: tasks run through 'count_drops' count into
+    the dict of their collection, so that concurrent collections do not
+    report each other's drops.
+    '''
+
+    def __init__(self, max_series=None):
+        self.max_series = max_series
+        self.lock = threading.Lock()
+        self.dropped = dict()
+
+    def add_metric(self, gauge: GaugeMetricFamily, labels, value, timestamp=None) -> bool:
+        if self.max_series is not None and len(gauge.samples) >= self.max_series:
+            # families are built concurrently by the collection tasks
+            dropped = getattr(collection, 'dropped', None)
+            if dropped is None:
+                dropped = self.dropped
+            with self.lock:
+                if gauge.name not in dropped:
+                    logging.warning('Metric family {} exceeds {} series, truncated'.format(gauge.name,
+                                                                                           self.max_series))
+                dropped[gauge.name] = dropped.get(gauge.name, 0) + 1
+            return False
+        gauge.add_metric(labels, value, timestamp)
+        return True
+
+    def truncated(self, gauge: GaugeMetricFamily) -> bool:
+        # a family at the cap may have lost series
+        return self.max_series is not None and len(gauge.samples) >= self.max_series
+
+    def dropped_gauge(self, dropped: dict = None) -> GaugeMetricFamily:
+        gauge = GaugeMetricFamily('aliyun_exporter_dropped_series',
+                                  'Series dropped by max_series in the last collection.', labels=['family'])
+        if dropped is None:
+            with self.lock:
+                dropped, self.dropped = self.dropped, dict()
+        for name, count in sorted(dropped.items()):
+            gauge.add_metric([name], count)
+        return gauge
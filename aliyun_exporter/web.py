@@ -1,26 +1,71 @@
 import json
+from urllib.parse import parse_qs
 
+import yaml
 from aliyunsdkcore.client import AcsClient
 from flask import (
-    Flask, render_template
+    Flask, render_template, request
 )
 from prometheus_client import make_wsgi_app
+from prometheus_client.core import REGISTRY
+from prometheus_client.exposition import choose_encoder
 from werkzeug.wsgi import DispatcherMiddleware
 
-from aliyun_exporter import CollectorConfig
+from aliyun_exporter.collector import AliyunCollector, CollectorConfig, Selection
 from aliyun_exporter.QueryMetricMetaRequest import QueryMetricMetaRequest
 from aliyun_exporter.QueryProjectMetaRequest import QueryProjectMetaRequest
+from aliyun_exporter.planner import Planner
 from aliyun_exporter.utils import format_metric, format_period
 
 
-def create_app(config: CollectorConfig):
+class SelectionRegistry(object):
+
+    def __init__(self, collector: AliyunCollector, selection: Selection):
+        self.collector = collector
+        self.selection = selection
+
+    def collect(self):
+        return self.collector.collect(self.selection)
+
+
+def metrics_app(collector: AliyunCollector):
+    '''
+    Serve /metrics, the whole default registry, or only a slice of the
+    collector selected by query parameters, e.g. '?project=acs_rds_dashboard'
+    or '?info=only'.
+
+    In push mode the collector is not scraped, slices are refused rather
+    than collected on demand.
+    '''
+    def app(environ, start_response):
+        params = parse_qs(environ.get('QUERY_STRING', ''))
+        try:
+            selection = Selection.from_params(params)
+        except ValueError as e:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return [str(e).encode('utf-8')]
+        registry = REGISTRY
+        if selection.key() != Selection().key():
+            if collector.config.push is not None:
+                start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+                return [b'Filtered collection is disabled in push mode']
+            registry = SelectionRegistry(collector, selection)
+        encoder, content_type = choose_encoder(environ.get('HTTP_ACCEPT'))
+        output = encoder(registry)
+        start_response('200 OK', [('Content-Type', content_type)])
+        return [output]
+    return app
+
+
+def create_app(config: CollectorConfig, collector: AliyunCollector = None):
 
     app = Flask(__name__, instance_relative_config=True)
 
+    credential = config.accounts[0].credential if config.accounts else config.credential
     client = AcsClient(
-        ak=config.credential['access_key_id'],
-        secret=config.credential['access_key_secret'],
-        region_id=config.credential['region_id']
+        ak=credential['access_key_id'],
+        secret=credential['access_key_secret'],
+        region_id=credential.get('region_id', 'cn-hangzhou')
     )
 
     @app.route("/")
@@ -56,12 +101,44 @@ def create_app(config: CollectorConfig):
         except Exception as e:
             return render_template("error.html", errorMsg=e)
         data = json.loads(resp)
-        return render_template("yaml.html", metrics=data["Resources"]["Resource"], project=name)
+        metrics = data["Resources"]["Resource"]
+        try:
+            planner = Planner(config, collector, interval=request.args.get('interval', 60, type=int))
+        except ValueError as e:
+            return render_template("error.html", errorMsg=e)
+        return render_template("yaml.html", metrics=metrics, project=name, interval=planner.interval,
+                               cost=planner.project_cost(name, len(metrics)))
+
+    @app.route("/planner", methods=['GET', 'POST'])
+    def planner():
+        '''
+        Plan the running configuration, or the YAML configuration posted in
+        the 'config' field. Posted configurations without credentials use
+        the running one.
+        '''
+        interval = request.values.get('interval', 60, type=int)
+        latency = request.values.get('latency', 0.5, type=float)
+        text = request.form.get('config')
+        plan_config = config
+        # a posted configuration is only checked by planning it
+        try:
+            if text:
+                cfg = yaml.safe_load(text) or {}
+                if 'credential' not in cfg and 'accounts' not in cfg:
+                    cfg['credential'] = dict(credential)
+                plan_config = CollectorConfig(**cfg)
+            planner = Planner(plan_config, collector, interval=interval, latency=latency)
+            plans = planner.plan()
+            total = planner.total(plans)
+        except Exception as e:
+            return render_template("error.html", errorMsg=e)
+        return render_template("planner.html", plans=plans, total=total, interval=interval, latency=latency,
+                               config=text or '')
 
     app.jinja_env.filters['formatmetric'] = format_metric
     app.jinja_env.filters['formatperiod'] = format_period
 
     app_dispatch = DispatcherMiddleware(app, {
-        '/metrics': make_wsgi_app()
+        '/metrics': make_wsgi_app() if collector is None else metrics_app(collector)
     })
     return app_dispatch
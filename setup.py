@@ -49,6 +49,10 @@ setup(
         "aliyun-python-sdk-elasticsearch==3.0.17",
         "aliyun-python-sdk-vpc==3.0.10",
     ],
+    extras_require={
+        'fast': ['orjson'],
+        'snappy': ['python-snappy'],
+    },
     entry_points={
         'console_scripts': [
             'aliyun-exporter=aliyun_exporter:main',